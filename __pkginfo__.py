@@ -9,7 +9,7 @@ from glob import glob
 modname = 'container'
 distname = 'cubicweb-container'
 
-numversion = (3, 0, 0)
+numversion = (3, 1, 0)
 version = '.'.join(str(num) for num in numversion)
 
 license = 'LGPL'
@@ -60,7 +60,12 @@ class Container(object):
         """Return concrete subclasses of the SetContainerRelation hook with
         selector set for *all* the containers and the NewContainer
         hook with selector set for each container type.
+
+        The relation hook selector starts with a `match_rtype` of the
+        structural rtypes: the hooks manager prunes the hook for other
+        rtypes (once per transaction and rtype), before any selection.
         """
+        from cubicweb.server.hook import match_rtype
         from cubes.container.hooks import SetContainerRelation, NewContainer, match_rdefs
         cetypes = []
         rdefs = set()
@@ -72,9 +77,10 @@ class Container(object):
             for rtype, from_to in container._container_parent_rdefs.iteritems():
                 parentrdefs[rtype] |= from_to
         prefix = ''.join(cetypes)
+        rtypes = sorted(set(rdef.rtype.type for rdef in rdefs))
         setrelationhook = type(prefix + 'ContainerRelationHook',
                                (SetContainerRelation,),
-                               {'__select__': match_rdefs(*rdefs),
+                               {'__select__': match_rtype(*rtypes) & match_rdefs(*rdefs),
                                 '__registry__': 'after_add_relation_hooks',
                                 '_container_parent_rdefs': parentrdefs})
         newcontainerhook = type(prefix + 'NewContainer',
@@ -92,6 +98,14 @@ class Container(object):
     subcontainers = ()
     clone_rtype_role = None
     compulsory_hooks_categories = ()
+    clone_page_size = None
+    clone_fused_fetch = False
+    clone_subcontainers_batch_size = None
+    clone_engine = 'python'
+    clone_in_background = False
+    clone_chunked = False
+    clone_snapshot = False
+    clone_fulltext_index = False
 
     def __init__(self,
                  cetype,
@@ -100,7 +114,15 @@ class Container(object):
                  skipetypes=(),
                  subcontainers=(),
                  clone_rtype_role=None,
-                 compulsory_hooks_categories=('metadata',)):
+                 compulsory_hooks_categories=('metadata',),
+                 clone_page_size=None,
+                 clone_fused_fetch=False,
+                 clone_subcontainers_batch_size=None,
+                 clone_engine='python',
+                 clone_in_background=False,
+                 clone_chunked=False,
+                 clone_snapshot=False,
+                 clone_fulltext_index=False):
 
         self.cetype = cetype
         self.crtype = crtype
@@ -109,6 +131,16 @@ class Container(object):
         self.subcontainers = set(subcontainers)
         self.clone_rtype_role = clone_rtype_role
         self.compulsory_hooks_categories = compulsory_hooks_categories
+        self.clone_page_size = clone_page_size
+        self.clone_fused_fetch = clone_fused_fetch
+        self.clone_subcontainers_batch_size = clone_subcontainers_batch_size
+        assert clone_engine in ('python', 'sql'), clone_engine
+        self.clone_engine = clone_engine
+        self.clone_in_background = clone_in_background
+        self.clone_chunked = clone_chunked
+        self.clone_snapshot = clone_snapshot
+        assert clone_fulltext_index in (False, True, 'background'), clone_fulltext_index
+        self.clone_fulltext_index = clone_fulltext_index
 
         self._schema = None
 
@@ -122,7 +154,8 @@ class Container(object):
         if self._schema is not None and self._schema is not schema:
             # empty schema dependant caches
             for cached in ('rdefs', 'inner_rdefs', 'border_rdefs',
-                           'etypes', 'ordered_etypes', '_container_parent_rdefs'):
+                           'etypes', 'ordered_etypes', 'clone_ordered_etypes',
+                           '_container_parent_rdefs'):
                 try:
                     delattr(self, cached)
                 except AttributeError:
@@ -433,6 +466,48 @@ class Container(object):
             total_order += order
         return total_order + etype_map.keys()
 
+    @cachedproperty
+    def clone_ordered_etypes(self):
+        """Return the etypes of the container in the order they are cloned
+        (see `clone_order`).
+        """
+        return self.clone_order()[0]
+
+    def clone_order(self, counts=None):
+        """Return the etypes of the container in an order minimizing the
+        inlined relations whose targets are not yet cloned when their
+        subject is, plus the set of the (etype, rtype) inlined relations
+        for which this cannot be avoided.
+
+        Cycles of inlined relations are broken on the nullable relations
+        with the fewest values first, as given by `counts` (a dict from
+        (etype, rtype) to the number of valued relations, such as the
+        `inlined` attribute of a CloneEstimate). Otherwise the
+        `ordered_etypes` order is kept.
+        """
+        counts = counts or {}
+        etypes = self.etypes
+        skiprtypes = self.skiprtypes | set((self.crtype,))
+        edges = {}
+        weights = {}
+        for etype in etypes:
+            for rschema in self.schema[etype].subject_relations():
+                rtype = rschema.type
+                if not rschema.inlined or rtype in skiprtypes:
+                    continue
+                rdefs = [rdef for rdef in rschema.rdefs.itervalues()
+                         if rdef.subject.type == etype]
+                targets = set(rdef.object.type for rdef in rdefs) & etypes
+                if not targets:
+                    continue
+                nullable = all(rdef.cardinality[0] == '?' for rdef in rdefs)
+                edges[(etype, rtype)] = targets
+                weights[(etype, rtype)] = (not nullable, counts.get((etype, rtype), 0))
+        ordered = [etype for etype in self.ordered_etypes if etype in etypes]
+        ordered += sorted(etypes - set(ordered))
+        rank = dict((etype, idx) for idx, etype in enumerate(ordered))
+        return utils.cycle_breaking_order(edges, weights, rank)
+
     # /accessors
     # /API
 
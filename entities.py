@@ -15,8 +15,9 @@
 # with this program. If not, see <http://www.gnu.org/licenses/>.
 
 """cubicweb-container entity's classes"""
-from collections import defaultdict
-from itertools import chain
+from array import array
+from collections import defaultdict, deque
+from itertools import chain, izip
 from warnings import warn
 
 from logilab.common.decorators import cached, cachedproperty
@@ -25,6 +26,7 @@ from rql import parse
 
 from cubicweb import neg_role, onevent
 from cubicweb.server.ssplanner import READ_ONLY_RTYPES
+from cubicweb.server.sqlutils import SQL_PREFIX
 
 from cubicweb.schema import VIRTUAL_RTYPES
 from cubicweb.view import EntityAdapter
@@ -32,9 +34,23 @@ from cubicweb.view import EntityAdapter
 from cubes.fastimport.entities import FlushController
 
 from cubes.container.config import Container, clear_callback
-from cubes.container.utils import (parent_rdefs,
+from cubes.container.journal import CloneJournal
+from cubes.container.metrics import CloneEstimate, CloneMetrics
+from cubes.container.snapshot import ContainerSnapshot, get_snapshot
+from cubes.container.sqlclone import SQLCloneEngine
+from cubes.container.utils import (EID_TYPECODE,
+                                   EidMap,
+                                   RelationBuffer,
+                                   bare_entities,
+                                   bulk_set_inlined,
+                                   component,
+                                   composite,
+                                   fti_index_eids,
+                                   parent_rdefs,
                                    needs_container_parent,
                                    _add_rqlst_restriction,
+                                   _add_rqlst_paging,
+                                   _add_rqlst_eid,
                                    _iter_mainvar_relations)
 
 
@@ -76,6 +92,12 @@ class ContainerProtocol(EntityAdapter):
 
     @property
     def parent(self):
+        """ the parent entity, or None
+
+        The container_parent of an entity created in the transaction is
+        only set before commit (see hooks.SetContainerParentOp): until
+        then its parent is None.
+        """
         if needs_container_parent(self.entity.e_schema):
             parent = self.entity.container_parent
             return parent[0] if parent else None
@@ -95,6 +117,116 @@ class ErrorHandler(object):
         raise exception
 
 
+# (clone adapter class, container etype) -> ClonePlan
+_CLONE_PLANS = {}
+
+
+class ClonePlan(object):
+    """ the static (schema dependant) facts a ContainerClone runs from
+
+    A plan is computed once per clone adapter class and container etype
+    and kept until the next registry reload: it must hence only depend on
+    the schema and on class level settings of the adapter.
+    """
+    # guard against cloning again the container itself
+    guard = ', NOT X eid IN (%(orig)s, %(clone)s)'
+
+    def __init__(self, cloner):
+        self.schema = cloner._cw.vreg.schema
+        self.cetype = cloner.entity.cw_etype
+        self.crtype = cloner.config.crtype
+        self.etypes = list(cloner.clonable_etypes())
+        self.etype_rank = dict((etype, rank) for rank, etype in enumerate(self.etypes))
+        self.inner_etypes = frozenset(self.etypes) | frozenset((self.cetype,))
+        # etype -> fetch rql, fetched rtypes, inlined rtypes
+        self.fetch_rql = {}
+        self.fetched_rtypes = {}
+        self.inlined_rtypes = {}
+        # etype -> inlined rtypes statically crossing border / already cloned
+        self.crossing_border = {}
+        self.already_cloned = {}
+        # etype -> [(rtype, relink rql)]
+        self.relink_rql = {}
+        self._paged_fetch_rql = {}
+        self._paged_relink_rql = {}
+        for etype in self.inner_etypes:
+            fragment = self.guard if etype == self.cetype else ''
+            rqlst, fetched_rtypes, inlined_rtypes = cloner._etype_fetch_rqlst(etype, fragment)
+            self.fetch_rql[etype] = rqlst.as_string()
+            self.fetched_rtypes[etype] = fetched_rtypes
+            self.inlined_rtypes[etype] = frozenset(inlined_rtypes)
+            crossing, cloned = set(), set()
+            for rtype in inlined_rtypes:
+                if self.crosses_border(etype, rtype):
+                    crossing.add(rtype)
+                elif self.already_cloned_targets(etype, rtype):
+                    cloned.add(rtype)
+            self.crossing_border[etype] = frozenset(crossing)
+            self.already_cloned[etype] = frozenset(cloned)
+            etype_rql = cloner._complete_rql(etype)
+            relink = []
+            for rtype in cloner.clonable_rtypes(etype):
+                rqlst = parse(etype_rql).children[0]
+                # Any X WHERE X <container> C, ... => Any X,Y WHERE ..., X <rtype> Y
+                _add_rqlst_restriction(rqlst, rtype)
+                relink.append((rtype, rqlst.as_string()))
+            self.relink_rql[etype] = relink
+        # container subject relations
+        self.container_relink_rql = [
+            (rtype, 'Any X,Y WHERE X eid %%(container)s, X %s Y' % rtype,
+             'Any Y LIMIT 1 WHERE X eid %%(clone)s, X %s Y' % rtype)
+            for rtype, _rql in self.relink_rql[self.cetype]]
+
+    def paged_fetch_rql(self, etype, page_size):
+        """ the fetch rql of `etype`, ordered by eid and limited to
+        `page_size` rows with eids greater than %(lasteid)s """
+        key = (etype, page_size)
+        rql = self._paged_fetch_rql.get(key)
+        if rql is None:
+            rqlst = parse(self.fetch_rql[etype]).children[0]
+            _add_rqlst_paging(rqlst, page_size)
+            rql = self._paged_fetch_rql[key] = rqlst.as_string()
+        return rql
+
+    def paged_relink_rql(self, etype, rtype, page_size):
+        """ the relink rql of (`etype`, `rtype`) ordered by subject eid and
+        limited to `page_size` rows with subjects greater than %(lasteid)s,
+        and the one of the links of the %(subject)s eid only """
+        key = (etype, rtype, page_size)
+        rqls = self._paged_relink_rql.get(key)
+        if rqls is None:
+            rql = dict(self.relink_rql[etype])[rtype]
+            pagedst = parse(rql).children[0]
+            _add_rqlst_paging(pagedst, page_size)
+            subjectst = parse(rql).children[0]
+            _add_rqlst_eid(subjectst, 'subject')
+            rqls = self._paged_relink_rql[key] = (pagedst.as_string(), subjectst.as_string())
+        return rqls
+
+    def crosses_border(self, etype, rtype):
+        """ Tells whether the (etype, rtype, *) relation
+        has ALL its targets outside of the container """
+        if rtype == 'container_parent':
+            # it is technically possible that it crosses the border
+            # but a container_parent, by design, is always an inner
+            # container relation
+            return False
+        return all(target not in self.inner_etypes
+                   for target in self.schema[rtype].targets(etype))
+
+    def already_cloned_targets(self, etype, rtype):
+        """ Tells whether all targets in the (etype, rtype, TARGET)
+        relation can have been already cloned """
+        # a shortcut for the container relation
+        if rtype == self.crtype:
+            return True
+        rank = self.etype_rank
+        if etype not in rank:
+            return False
+        return all(target in rank and rank[etype] > rank[target]
+                   for target in self.schema[rtype].targets(etype))
+
+
 class ContainerClone(EntityAdapter):
     """ allows to clone big sized containers while being relatively fast
     and not too memory hungry
@@ -105,6 +237,14 @@ class ContainerClone(EntityAdapter):
     rtypes_to_skip = set()
     etypes_to_skip = set()
     nesting = 0
+    # number of links handed at once to the flush controller
+    relation_batch_size = 10000
+    # number of clones loaded at once to be full text indexed
+    fti_batch_size = 1000
+    # the CloneJournal of a chunked clone
+    _journal = None
+    # the ContainerSnapshot of the original container (see clone_snapshot)
+    _snapshot = None
 
     def __init__(self, *args, **kwargs):
         super(ContainerClone, self).__init__(*args, **kwargs)
@@ -120,6 +260,58 @@ class ContainerClone(EntityAdapter):
     def compulsory_hooks_categories(self):
         return self.config.compulsory_hooks_categories
 
+    @cachedproperty
+    def clone_fused_fetch(self):
+        """ if True, the non-inlined relations of an etype are fetched with
+        one sql query instead of one rql query per rtype (this bypasses rql
+        read security) """
+        return self.config.clone_fused_fetch
+
+    @cachedproperty
+    def clone_subcontainers_batch_size(self):
+        """ if set, subcontainers are cloned by batches of that many
+        containers of the same etype instead of one by one """
+        return self.config.clone_subcontainers_batch_size
+
+    @cachedproperty
+    def clone_engine(self):
+        """ 'python' (the default) or 'sql' to copy everything with
+        INSERT ... SELECT statements (see sqlclone.SQLCloneEngine)
+
+        Only the sql engine reserves the eids of the clones by blocks (see
+        utils.reserve_eids): the python one lets the flush controller
+        create them, one at a time. """
+        return self.config.clone_engine
+
+    @cachedproperty
+    def clone_chunked(self):
+        """ if True, the clone commits after each etype and rtype and can
+        be resumed after a failure (see `clone_incomplete`) """
+        return self.config.clone_chunked
+
+    @cachedproperty
+    def clone_snapshot(self):
+        """ if True, the rows read from an original container are kept
+        in memory (until something changes in it) and repeated clones of
+        this container skip the read phase (see snapshot.ContainerSnapshot)
+
+        The snapshots are only invalidated when the container configuration
+        enables them: don't enable them on the adapter only. """
+        return self.config.clone_snapshot
+
+    @cachedproperty
+    def clone_fulltext_index(self):
+        """ if True, the clones of full text indexed etypes are indexed at
+        the end of the clone (by batches of `fti_batch_size`), if
+        'background', in a thread once the clone is committed """
+        return self.config.clone_fulltext_index
+
+    @cachedproperty
+    def clone_page_size(self):
+        """ number of entities of a given etype fetched and inserted at
+        once (None means all of them in one go) """
+        return self.config.clone_page_size
+
     # These two unimplemented properties are bw compat
     # to drive users from entity.clone_(e/r)types_to_skip
     # to adapter.(e/r)types_to_skip
@@ -142,62 +334,422 @@ class ContainerClone(EntityAdapter):
         At the end, self.entity is the fully cloned container.
         """
         self.orig_container_eid = self._origin_eid(original)
-        orig_to_clone = {self.orig_container_eid: self.entity.eid}
-        relations = defaultdict(list)
+        if self.clone_engine == 'sql':
+            if self._sql_clonable():
+                SQLCloneEngine(self).clone()
+                return
+            self.warning('%s: the sql clone engine cannot honor the adapter '
+                         'customizations, using the python one', self.entity.cw_etype)
+        if self.clone_snapshot:
+            self._snapshot = get_snapshot(self.__class__, self.orig_container_eid)
+        if self.clone_chunked:
+            self._chunked_clone()
+            return
+        orig_to_clone = EidMap({self.orig_container_eid: self.entity.eid})
+        relations = RelationBuffer()
         self._inner_clone(orig_to_clone, relations, 0)
 
         # the top container itself is walked: its subject relations have not yet
         # been collected
-        for rtype, from_to in self._container_relink(orig_to_clone).iteritems():
-            relations[rtype].extend(from_to)
+        relations.update(self._container_relink(orig_to_clone))
+
+        self._link(relations, orig_to_clone)
+        self._run_deferred_hooks()
+        self._fulltext_index(self._clone_eids(orig_to_clone))
+        self.metrics.progress('done')
+
+    def fan_out(self, others, original=None):
+        """ clone `original` (as in `clone`) into this container and into
+        each of the `others` prepared containers, of the same etype
+
+        With the sql engine, the original is read once and all copies are
+        written together. The python engine clones the containers one
+        after the other but reads the original once (all the cloners
+        share a snapshot of it).
+        """
+        self.orig_container_eid = self._origin_eid(original)
+        others = list(others)
+        assert all(other.cw_etype == self.entity.cw_etype for other in others), others
+        if self.clone_engine == 'sql' and self._sql_clonable():
+            SQLCloneEngine(self, others).clone()
+            return
+        snapshot = ContainerSnapshot(self.orig_container_eid)
+        for clone in [self.entity] + others:
+            cloner = self if clone is self.entity else clone.cw_adapt_to('Container.clone')
+            # replaced by the process wide one if clone_snapshot is set
+            cloner._snapshot = snapshot
+            cloner.metrics = self.metrics
+            cloner.clone(original=self.orig_container_eid)
+
+    def clone_subtree(self, root):
+        """ clone the inner entity `root` (an eid) and its descendants
+        (following the structural relations of the container) into this
+        very container, and return the eid of the clone of `root`
+
+        Links to entities out of the subtree are kept as is and the clone
+        of `root` gets the (multiple) parents of `root`. Subcontainers are
+        not part of a subtree.
+        """
+        if not self._default_scope():
+            raise ValueError('%s has a custom container scope (_complete_rql) but '
+                             'clone_subtree only supports the default one'
+                             % self.__class__.__name__)
+        self.orig_container_eid = self.entity.eid
+        subtree = self._subtree_eids(root)
+        orig_to_clone = EidMap({self.entity.eid: self.entity.eid})
+        relations = RelationBuffer()
+        self._subtree = dict((etype, sorted(eids)) for etype, eids in subtree.iteritems())
+        try:
+            for etype in self.plan.etypes:
+                if etype in subtree:
+                    self._checkpointed_etype_clone(etype, orig_to_clone, relations)
+        finally:
+            self._subtree = None
+        clone = orig_to_clone[root]
+        self._link(relations, orig_to_clone)
+        self._link_subtree_root(root, clone)
+        self._run_deferred_hooks()
+        self._fulltext_index(self._clone_eids(orig_to_clone))
+        self.metrics.progress('done')
+        return clone
+
+    def _subtree_eids(self, root):
+        """ etype -> eids of `root` and its descendants, walking down the
+        structural relations of the container level by level """
+        cnx = self._cw
+        config = self.config
+        inner = set(self.plan.etypes) - set(config.subcontainers)
+        etype = cnx.entity_metas(root)['type']
+        if etype not in inner or root == self.entity.eid:
+            raise ValueError('%s is not an inner entity of %s' % (root, config))
+        children = defaultdict(list)
+        for rdef in config.rdefs:
+            if component(rdef).type in inner:
+                children[composite(rdef).type].append(rdef)
+        subtree = defaultdict(set)
+        subtree[etype].add(root)
+        pending = deque([(etype, [root])])
+        while pending:
+            etype, eids = pending.popleft()
+            eids_in = ','.join(str(eid) for eid in eids)
+            for rdef in children[etype]:
+                cetype = component(rdef).type
+                if rdef.composite == 'subject':
+                    rql = 'Any Y WHERE X eid IN (%s), X %s Y, Y is %s'
+                else:
+                    rql = 'Any Y WHERE X eid IN (%s), Y %s X, Y is %s'
+                new = [eid for eid, in cnx.execute(rql % (eids_in, rdef.rtype, cetype))
+                       if eid not in subtree[cetype]]
+                if new:
+                    subtree[cetype].update(new)
+                    pending.append((cetype, new))
+        return subtree
+
+    def _link_subtree_root(self, root, clone):
+        """ give the clone of a subtree `root` the parents which point to
+        `root` through a non inlined relation (the others come with its
+        attributes) """
+        cnx = self._cw
+        eschema = cnx.vreg.schema[cnx.entity_metas(root)['type']]
+        for rdef in parent_rdefs(eschema):
+            rtype = rdef.rtype.type
+            if (rdef.composite != 'subject' or rdef.object != eschema or
+                    rdef.rtype.inlined or rdef.cardinality[0] not in '*+'):
+                continue
+            parents = [eid for eid, in cnx.execute(
+                'Any P WHERE P %s X, X eid %%(x)s, P is %s' % (rtype, rdef.subject),
+                {'x': root})]
+            if parents:
+                self._insert_relations_by_eid(rtype, array(EID_TYPECODE, parents),
+                                              array(EID_TYPECODE, [clone] * len(parents)))
+                self.metrics.linked[rtype] += len(parents)
+
+    def _chunked_clone(self):
+        """ the clone, committed after each etype (of the container and
+        subcontainers) and each linked rtype, which resumes an interrupted
+        chunked clone into the same container """
+        journal = self._journal = CloneJournal(self._cw, self.entity.eid)
+        orig_to_clone = journal.mapping()
+        relations = RelationBuffer()
+        if 'started' in journal.steps:
+            self.info('resuming the clone into %s (%d entities already cloned)',
+                      self.entity.eid, len(orig_to_clone))
+        else:
+            orig_to_clone[self.orig_container_eid] = self.entity.eid
+            self._checkpoint('started', orig_to_clone, relations)
+        self._inner_clone(orig_to_clone, relations, 0)
+        if 'relinked' not in journal.steps:
+            relations.update(self._container_relink(orig_to_clone))
+            self._checkpoint('relinked', orig_to_clone, relations)
+        self._link(journal.links(), orig_to_clone, journal)
+        self._run_deferred_hooks()
+        self._fulltext_index(self._clone_eids(orig_to_clone))
+        # the last transaction is left to the caller
+        journal.clear()
+        self.metrics.progress('done')
+
+    def _checkpoint(self, step, orig_to_clone, relations):
+        """ in chunked mode, record the progress of the clone and commit """
+        journal = self._journal
+        if journal is None:
+            return
+        self._run_deferred_hooks()
+        journal.record(orig_to_clone, relations)
+        journal.done(step)
+        self._cw.commit()
+
+    def explain(self, original=None):
+        """ estimate the cost of cloning `original` (as in `clone`) into
+        our entity, without cloning anything, and return a CloneEstimate
+
+        The counts are computed with two aggregate queries per container
+        level (the container, then the subcontainers of the previous
+        level of a given etype), grouped on the container rtype. Only the
+        default container scope is supported (ValueError is raised
+        otherwise).
+
+        The queries and memory are those of the engine the clone would use
+        (see `clone_engine`): the sql one keeps the mapping in a temporary
+        table and copies the relations in the database.
+        """
+        if not self._default_scope():
+            raise ValueError('%s has a custom container scope (_complete_rql) but '
+                             'explain only supports the default one'
+                             % self.__class__.__name__)
+        cnx = self._cw
+        estimate = CloneEstimate()
+        if self.clone_engine == 'sql' and self._sql_clonable():
+            estimate.engine = 'sql'
+        # the cloners of the levels
+        levels = []
+        # (cloner of the level container etype, sql of the level
+        #  containers eids, number of containers, top level)
+        pending = deque([(self, str(self._origin_eid(original)), 1, True)])
+        while pending:
+            cloner, containers, ncontainers, toplevel = pending.popleft()
+            levels.append(cloner)
+            estimate.containers[cloner.entity.cw_etype] += ncontainers
+            self._explain_level(estimate, cloner, containers, ncontainers, toplevel)
+            for cetype in cloner.config.subcontainers:
+                # containers are in their own container
+                subcontainers = ('SELECT %(p)seid FROM %(p)s%(cetype)s '
+                                 'WHERE %(p)s%(crtype)s IN (%(containers)s) '
+                                 'AND %(p)seid <> %(p)s%(crtype)s'
+                                 % {'p': SQL_PREFIX, 'cetype': cetype,
+                                    'crtype': cloner.config.crtype,
+                                    'containers': containers})
+                count, first = cnx.system_sql('SELECT COUNT(*), MIN(sub.%seid) FROM (%s) AS sub'
+                                              % (SQL_PREFIX, subcontainers)).fetchone()
+                if count:
+                    subcloner = cnx.entity_from_eid(first).cw_adapt_to('Container.clone')
+                    pending.append((subcloner, subcontainers, count, False))
+        if estimate.engine == 'sql':
+            self._explain_sql(estimate, levels)
+            return estimate
+        # the final linking, by batches
+        def batches(count):
+            return -(-count // self.relation_batch_size)
+        for count in estimate.links.itervalues():
+            # insertion plus subject and object etypes lookups
+            estimate.queries += 3 * batches(count)
+        deferred = defaultdict(int)
+        for etype, rtype in estimate.deferred_inlined:
+            deferred[rtype] += estimate.inlined[(etype, rtype)]
+        for count in deferred.itervalues():
+            # subject etypes lookup plus one update per etype
+            estimate.queries += 2 * batches(count)
+        return estimate
+
+    def _explain_level(self, estimate, cloner, containers, ncontainers, toplevel):
+        cnx = self._cw
+        plan = cloner.plan
+        where = ('FROM %(p)s%%s AS x WHERE x.%(p)s%(crtype)s IN (%(containers)s) '
+                 'AND x.%(p)seid <> x.%(p)s%(crtype)s'
+                 % {'p': SQL_PREFIX, 'crtype': plan.crtype, 'containers': containers})
+        counts, links = [], []
+        for etype in plan.etypes:
+            counts.append("SELECT '%s', '', COUNT(*) " % etype + where % etype)
+            for rtype in sorted(plan.inlined_rtypes[etype]):
+                counts.append("SELECT '%s', '%s', COUNT(x.%s%s) "
+                              % (etype, rtype, SQL_PREFIX, rtype) + where % etype)
+                if (rtype in plan.crossing_border[etype] or
+                    rtype in plan.already_cloned[etype]):
+                    estimate.fast_inlined.add((etype, rtype))
+                else:
+                    estimate.deferred_inlined.add((etype, rtype))
+            for rtype, _rql in plan.relink_rql[etype]:
+                rschema = cnx.vreg.schema[rtype]
+                if rschema.symmetric or getattr(rschema, 'rule', None):
+                    continue
+                links.append("SELECT '%s', COUNT(*) FROM %s_relation AS rel, "
+                             % (rtype, rtype) + where % etype +
+                             ' AND rel.eid_from=x.%seid' % SQL_PREFIX)
+        level_entities = {}
+        for etype, rtype, count in cnx.system_sql(' UNION ALL '.join(counts)).fetchall():
+            if rtype:
+                estimate.inlined[(etype, rtype)] += count
+            else:
+                estimate.entities[etype] += count
+                level_entities[etype] = count
+        if links:
+            for rtype, count in cnx.system_sql(' UNION ALL '.join(links)).fetchall():
+                estimate.links[rtype] += count
+        if estimate.engine != 'python':
+            return
+        # the queries of the python engine for this level
+        if toplevel:
+            runs = 1
+        elif self.clone_subcontainers_batch_size:
+            runs = -(-ncontainers // self.clone_subcontainers_batch_size)
+        else:
+            runs = ncontainers
+        page_size = self.clone_page_size
+        for etype in plan.etypes:
+            count = level_entities.get(etype, 0) / float(runs)
+            pages = max(1, int(-(-count // page_size))) if page_size else 1
+            estimate.queries += runs * pages
+            if count:
+                if self.clone_fused_fetch and not page_size:
+                    relink = 1
+                else:
+                    relink = len(plan.relink_rql[etype]) * pages
+                # the insertions plus the relations fetch
+                estimate.queries += runs * (pages + relink)
+        if not toplevel:
+            # existing links check plus relations fetch
+            estimate.queries += runs * 2 * len(plan.container_relink_rql)
+
+    def _explain_sql(self, estimate, levels):
+        """ count the queries of the sql engine (see sqlclone.SQLCloneEngine),
+        given the cloners of the container `levels` """
+        schema = self._cw.vreg.schema
+        engine = SQLCloneEngine(self)
+        special = self._specially_handled_rtypes
+        # temporary tables, copies and top container mapping, eids
+        # reservation and mapping update, fulltext indexing
+        queries = 3 * len(engine.tables) + 5
+        etypes, rtypes = set(), set()
+        for cloner in levels:
+            plan = cloner.plan
+            # mapping (three queries without ROW_NUMBER) and insertion
+            queries += len(plan.etypes) * (2 if engine.row_number else 4)
+            # subcontainers lookup
+            queries += len(cloner.config.subcontainers)
+            etypes.update(plan.etypes)
+            for etype in plan.etypes:
+                rtypes.update(rtype for rtype, _rql in plan.relink_rql[etype]
+                              if rtype not in special and rtype != 'cw_source')
+        # entities table, owned_by, created_by and cw_source, then is and
+        # is_instance_of per etype
+        queries += 4 + sum(2 + len(schema[etype].ancestors()) for etype in etypes)
+        queries += sum(2 if schema[rtype].symmetric else 1 for rtype in rtypes)
+        queries += len([rtype for rtype, _rql, _existsrql in self.plan.container_relink_rql
+                        if rtype not in special and rtype != 'cw_source'])
+        estimate.queries = queries
+
+    def _clone_eids(self, orig_to_clone):
+        """ the eids of the entities created by the clone """
+        container = self.entity.eid
+        return [clone for _orig, clone in orig_to_clone.iteritems() if clone != container]
+
+    def _fulltext_index(self, eids):
+        """ full text index the cloned `eids` (see clone_fulltext_index) """
+        mode = self.clone_fulltext_index
+        if not mode:
+            return
+        if mode == 'background':
+            from cubes.container.hooks import FTIndexClonesOp
+            FTIndexClonesOp.get_instance(self._cw).union(set(eids))
+            return
+        with self.metrics.timed('fti'):
+            fti_index_eids(self._cw, eids, self.fti_batch_size)
+
+    def _run_deferred_hooks(self):
+        with self.metrics.timed('deferred_hooks'):
+            self.controller.run_deferred_hooks(ErrorHandler())
+
+    @cachedproperty
+    def metrics(self):
+        """ the CloneMetrics of the clone (shared with the subcontainers
+        cloners) """
+        return CloneMetrics(self.clone_progress)
+
+    def clone_progress(self, metrics, step):
+        """ called with the clone `metrics` after each cloned etype
+        ('etype:<container clone eid>:<etype>' step, or
+        'etype:<first clone eid>-<last clone eid>:<etype>' for a batch of
+        subcontainers), linked rtype
+        ('link:<rtype>' step) and at the end ('done' step) """
+        pass
 
-        # let's flush all collected relations
+    @property
+    def clone_incomplete(self):
+        """ tells whether a chunked clone into this container has been
+        started and is not finished """
+        return CloneJournal.incomplete(self._cw, self.entity.eid)
+
+    def _link(self, relations, orig_to_clone, journal=None):
+        """ insert all collected `relations`, committing after each rtype
+        if given the `journal` of a chunked clone """
         self.info('linking (%d relations)', len(relations))
         cnx = self._cw
-        ecache = cnx.transaction_data.get('ecache', {})
         internal_rtypes = set(rdef.rtype.type
                               for rdef in self.config.inner_rdefs)
         internal_rtypes.add('container_parent')
-        for rtype, eids in relations.iteritems():
-            self.info('%s linking %s (%s elements)' %
-                      ('internal' if rtype in internal_rtypes else 'external',
-                       rtype, len(eids)))
-            rschema = cnx.vreg.schema[rtype]
-            subj_obj = []
-            inlined_subj_obj = []
-            for subj, obj in eids:
-                newsubj = orig_to_clone[subj]
-                if newsubj == self.entity.eid:
-                    if rtype == 'cw_source':
-                        continue
-                if obj in orig_to_clone:
-                    # internal relinking, else it is a link
-                    # between internal and external nodes
-                    obj = orig_to_clone[obj]
-
-                # eids -> entities, for .insert_relations (real relations)
-                if not rschema.inlined:
-                    subjentity = ecache.get(newsubj)
-                    if subjentity is None:
-                        subjentity = cnx.entity_from_eid(newsubj)
-                    objentity = ecache.get(obj)
-                    if objentity is None:
-                        objentity = cnx.entity_from_eid(obj)
-                    subj_obj.append((subjentity, objentity))
-                else:
-                    inlined_subj_obj.append((newsubj, obj))
-
-            if rschema.inlined:
-                # inlined_subj_obj is a list of eid tuples
-                if inlined_subj_obj:
-                    self._cw.add_relations([(rtype, inlined_subj_obj)])
-            else:
-                # subj_obj is a list of entity tuples
-                if subj_obj:
-                    self.controller.insert_relations(rtype, subj_obj)
-
-        errors = ErrorHandler()
-        self.controller.run_deferred_hooks(errors)
+        for rtype in relations.rtypes():
+            step = 'link:%s' % rtype
+            if journal is not None and step in journal.steps:
+                continue
+            # internal relinking: both ends are translated, else it is a
+            # link between internal and external nodes
+            subjects, objects = relations.translated(rtype, orig_to_clone)
+            self.info('%s linking %s (%s elements)',
+                      'internal' if rtype in internal_rtypes else 'external',
+                      rtype, len(subjects))
+            if rtype == 'cw_source' and self.entity.eid in subjects:
+                # the clone already got its own source
+                pairs = [(subj, obj) for subj, obj in izip(subjects, objects)
+                         if subj != self.entity.eid]
+                subjects = array(EID_TYPECODE, [subj for subj, _obj in pairs])
+                objects = array(EID_TYPECODE, [obj for _subj, obj in pairs])
+            if subjects:
+                with self.metrics.timed('link'):
+                    if cnx.vreg.schema[rtype].inlined:
+                        # sending these to cnx.add_relations performs horribly
+                        bulk_set_inlined(cnx, rtype, subjects, objects,
+                                         self.relation_batch_size)
+                        self.metrics.inlined[rtype] += len(subjects)
+                    else:
+                        self._insert_relations_by_eid(rtype, subjects, objects)
+                        self.metrics.linked[rtype] += len(subjects)
+            if journal is not None:
+                # the deferred hooks of the committed links would be lost
+                # by a crash, a resumed clone does not link them again
+                self._run_deferred_hooks()
+                journal.done(step)
+                cnx.commit()
+            self.metrics.progress(step)
+
+    def _insert_relations_by_eid(self, rtype, subjects, objects):
+        """ insert the `rtype` (non inlined) links given as two columns of
+        subject and object eids, by batches of `relation_batch_size` links
+
+        The flush controller (which writes the rows and records the
+        deferred hooks) wants entity pairs: we hand it bare entities, built
+        without any database access and once per eid of a batch, the entity
+        types being computed in one query per batch when the rtype is
+        polymorphic.
+        """
+        cnx = self._cw
+        rschema = cnx.vreg.schema[rtype]
+        batchsize = self.relation_batch_size
+        for start in xrange(0, len(subjects), batchsize):
+            memo = {}
+            subjentities = bare_entities(cnx, subjects[start:start + batchsize],
+                                         rschema.subjects(), memo)
+            objentities = bare_entities(cnx, objects[start:start + batchsize],
+                                        rschema.objects(), memo)
+            self.controller.insert_relations(rtype, zip(subjentities, objentities))
 
     def _inner_clone(self, orig_to_clone, relations, nesting):
         self.nesting = nesting
@@ -213,35 +765,186 @@ class ContainerClone(EntityAdapter):
         clonable_etypes = list(self.clonable_etypes())
         for etype in clonable_etypes:
             cloned_etypes.append(etype)
-            for rtype, from_to in self._etype_clone(etype, orig_to_clone).iteritems():
-                relations[rtype].extend(from_to)
+            self._checkpointed_etype_clone(etype, orig_to_clone, relations)
 
         uncloned_etypes = set(cloned_etypes) - set(clonable_etypes)
         if uncloned_etypes:
             self.info('etypes %s were not cloned', uncloned_etypes)
 
+        if toplevel and self.clone_subcontainers_batch_size and self._default_scope():
+            self._delegate_clone_to_subcontainers_batched(orig_to_clone, relations)
+            return
+        if self._batched_walk:
+            # the subcontainers are walked by the top level cloner
+            return
         for cetype in subcontainers:
             self._delegate_clone_to_subcontainer(cetype, orig_to_clone, relations)
 
+    def _checkpointed_etype_clone(self, etype, orig_to_clone, relations):
+        """ clone `etype`, unless a resumed chunked clone already did """
+        if self._batch_origs is None:
+            step = 'etype:%s:%s' % (self.entity.eid, etype)
+        else:
+            # the batch is identified by the clones of its first and last
+            # containers
+            step = 'etype:%s-%s:%s' % (orig_to_clone[self._batch_origs[0]],
+                                       orig_to_clone[self._batch_origs[-1]], etype)
+        if self._journal is not None and step in self._journal.steps:
+            return
+        relations.update(self._etype_clone(etype, orig_to_clone))
+        self.metrics.mapping_size(len(orig_to_clone))
+        self._checkpoint(step, orig_to_clone, relations)
+        self.metrics.progress(step)
+
+    def _delegate_clone_to_subcontainers_batched(self, orig_to_clone, relations):
+        """ clone all the (transitive) subcontainers, one etype and batch
+        of `clone_subcontainers_batch_size` containers at a time
+
+        Containers are walked level by level using a queue rather than
+        by recursion, so deeply nested (e.g. self recursive) containers
+        are not an issue.
+
+        The subcontainers whose cloner is not `_batchable` are cloned one
+        at a time; those with a custom scope also clone their own
+        subcontainers, following that scope.
+        """
+        cnx = self._cw
+        batchsize = self.clone_subcontainers_batch_size
+        # (container etype, original container eids) whose subcontainers
+        # must be cloned
+        pending = deque([(self.entity.cw_etype, [self.orig_container_eid])])
+        while pending:
+            pcetype, porigs = pending.popleft()
+            pconf = Container.by_etype(pcetype)
+            porigs_set = set(porigs)
+            for cetype in pconf.subcontainers:
+                # ordered, for the batches of a resumed clone to be the same
+                rql = ('Any X ORDERBY X WHERE X is %s, X %s C, C eid IN (%s)' %
+                       (cetype, pconf.crtype, ','.join(str(eid) for eid in porigs)))
+                origs = [eid for eid, in self._read(rql)
+                         if eid not in porigs_set]
+                if not origs:
+                    continue
+                first = self._walk_cloner(orig_to_clone[origs[0]])
+                if not first._batchable():
+                    self.info('delegated cloning for %d %s', len(origs), cetype)
+                    walked = first._default_scope()
+                    for orig in origs:
+                        cloner = self._walk_cloner(orig_to_clone[orig])
+                        cloner.orig_container_eid = orig
+                        cloner._batched_walk = walked
+                        cloner._inner_clone(orig_to_clone, relations, nesting=self.nesting + 1)
+                        relations.update(cloner._container_relink(orig_to_clone))
+                    if walked:
+                        pending.append((cetype, origs))
+                    continue
+                self.info('batched delegated cloning for %d %s', len(origs), cetype)
+                for start in xrange(0, len(origs), batchsize):
+                    borigs = origs[start:start + batchsize]
+                    cloner = self._walk_cloner(orig_to_clone[borigs[0]])
+                    cloner._batched_inner_clone(borigs, orig_to_clone, relations)
+                pending.append((cetype, origs))
+
+    def _walk_cloner(self, clone):
+        """ the cloner of the subcontainer `clone` (an eid), sharing our
+        journal, snapshot and metrics """
+        cloner = self._cw.entity_from_eid(clone).cw_adapt_to('Container.clone')
+        cloner.nesting = self.nesting + 1
+        cloner._journal = self._journal
+        cloner._snapshot = self._snapshot
+        cloner.metrics = self.metrics
+        return cloner
+
+    def _batchable(self):
+        """ tells whether the contents of several containers can be cloned
+        at once by this cloner: it follows neither a custom scope nor the
+        preprocessing hooks (which may depend on the adapted container) """
+        return self._sql_clonable()
+
+    # eids of the containers whose contents are cloned at once by
+    # _batched_inner_clone, None in the standard (one container) mode
+    _batch_origs = None
+    # True when the subcontainers are walked by the top level cloner (see
+    # _delegate_clone_to_subcontainers_batched)
+    _batched_walk = False
+    # etype -> eids of the entities cloned by clone_subtree
+    _subtree = None
+
+    def _scoped(self, rql, etype):
+        """ adapt a (default scope) rql of `etype` from the plan to the
+        containers of a batched clone or to the `etype` entities of a
+        subtree clone """
+        if self._batch_origs is None and self._subtree is None:
+            return rql
+        scope = 'C eid %(container)s'
+        assert scope in rql, rql
+        if self._subtree is not None:
+            return rql.replace(scope, '%s, X eid IN (%s)' % (
+                scope, ','.join(str(eid) for eid in self._subtree[etype])))
+        return rql.replace(scope, 'C eid IN (%s)' % ','.join(str(eid) for eid
+                                                             in self._batch_origs))
+
+    def _batched_inner_clone(self, origs, orig_to_clone, relations):
+        """ clone the contents of the `origs` containers (of our etype, and
+        already cloned as entities of their parent containers) at once """
+        self._batch_origs = origs
+        self.orig_container_eid = origs[0]
+        try:
+            for etype in self.plan.etypes:
+                self._checkpointed_etype_clone(etype, orig_to_clone, relations)
+            relations.update(self._batched_container_relink(origs, orig_to_clone))
+        finally:
+            self._batch_origs = None
+
+    def _batched_container_relink(self, origs, orig_to_clone):
+        """ the batched version of `_container_relink` """
+        deferred_relations = []
+        relations = RelationBuffer()
+        clone_subject_relations = set(rschema.type
+                                      for rschema in self.entity.e_schema.subject_relations()
+                                      if not rschema.final)
+        origs_in = ','.join(str(eid) for eid in origs)
+        clones_in = ','.join(str(orig_to_clone[eid]) for eid in origs)
+        for rtype, _rql, _existsrql in self.plan.container_relink_rql:
+            already_linked = set()
+            if rtype in clone_subject_relations:
+                already_linked = set(eid for eid, in self._cw.execute(
+                    'DISTINCT Any X WHERE X eid IN (%s), X %s Y' % (clones_in, rtype)))
+            linked_rows = self._read('Any X,Y WHERE X eid IN (%s), X %s Y'
+                                     % (origs_in, rtype))
+            for ceid, linked_eid in linked_rows:
+                if orig_to_clone[ceid] in already_linked:
+                    continue
+                if rtype in self._specially_handled_rtypes:
+                    deferred_relations.append((rtype, ceid, linked_eid))
+                else:
+                    relations.add(rtype, ceid, linked_eid)
+        self._flush_deferred(deferred_relations, orig_to_clone)
+        return relations
+
 
     def _delegate_clone_to_subcontainer(self, cetype, orig_to_clone, relations):
         self.info('delegated cloning for %s', cetype)
         # get entities of type cetype except the original
         query = self._complete_rql(cetype) + ', NOT X eid %s' % self.orig_container_eid
-        candidates_rset = self._cw.execute(query, self._queryargs())
-        for candidate in candidates_rset.entities():
+        for candidate, in self._read(query, self._queryargs()):
             # fetch the container clone
             # NOTE: at this point a top-level clone has no <crtype> set yet
             #       but this subcontainer has been cloned and its relations
             #       prepared
-            cclone = self._cw.entity_from_eid(orig_to_clone[candidate.eid])
+            cclone = self._cw.entity_from_eid(orig_to_clone[candidate])
             assert getattr(cclone, self.config.crtype)[0].eid == self.entity.eid
             cloner = cclone.cw_adapt_to('Container.clone')
-            cloner.orig_container_eid = cloner._origin_eid(candidate.eid)
+            cloner.orig_container_eid = cloner._origin_eid(candidate)
+            cloner._journal = self._journal
+            cloner._snapshot = self._snapshot
+            cloner.metrics = self.metrics
             # the orig-clone mapping and relations will be augmented
             # by the delegated clone
             cloner._inner_clone(orig_to_clone, relations, nesting=self.nesting+1)
-            cloner._container_relink(orig_to_clone)
+            # this may push again links collected from our side, but the
+            # relation buffer deduplicates them
+            relations.update(cloner._container_relink(orig_to_clone))
 
     @cachedproperty
     def clone_rtype(self):
@@ -272,6 +975,25 @@ class ContainerClone(EntityAdapter):
                 raise TypeError('.clone wants the original or a relation to the original')
 
 
+    def _overridden(self, name):
+        """ tells whether the `name` method of ContainerClone is overridden,
+        by the adapter class (or a mixin) or on the adapter itself """
+        method = getattr(self, name)
+        return (getattr(method, '__func__', method) is not
+                getattr(ContainerClone, name).__func__)
+
+    def _default_scope(self):
+        """ tells whether the container scope is the default one (i.e.
+        `_complete_rql` has not been overridden) """
+        return (not hasattr(self.entity, '_complete_rql') and
+                not self._overridden('_complete_rql'))
+
+    def _sql_clonable(self):
+        """ tells whether the sql clone engine can be used: it follows
+        neither a custom scope nor the preprocessing hooks """
+        return (self._default_scope() and not self._preprocess_rows and
+                not self._overridden('preprocess_batch'))
+
     def _complete_rql(self, etype):
         """ etype -> rql to fetch all instances from the container """
         if hasattr(self.entity, '_complete_rql'):
@@ -346,117 +1068,169 @@ class ContainerClone(EntityAdapter):
 
     @cachedproperty
     def _ordered_etypes(self):
-        return list(self.clonable_etypes())
+        return self.plan.etypes
+
+    @cachedproperty
+    def plan(self):
+        """ the (cached) ClonePlan of this adapter class and container etype
+
+        A custom `_complete_rql` may depend on the adapted entity: its plan is
+        then built for this adapter only.
+        """
+        if not self._default_scope():
+            return ClonePlan(self)
+        key = (self.__class__, self.entity.cw_etype)
+        plan = _CLONE_PLANS.get(key)
+        if plan is None or plan.schema is not self._cw.vreg.schema:
+            plan = _CLONE_PLANS[key] = ClonePlan(self)
+        return plan
 
     def clonable_etypes(self):
         cconf = self.config
         # more skiprtypes must be deprecated
         # skiprtypes = set(cconf.skiprtypes) | set(self.rtypes_to_skip)
         skipetypes = set(cconf.skipetypes) | set(self.etypes_to_skip)
-        for etype in cconf.ordered_etypes:
+        for etype in cconf.clone_ordered_etypes:
             if etype not in skipetypes:
                 yield etype
 
     def _etype_clone(self, etype, orig_to_clone):
-        # 0/ guard against cloning again the container itself
-        guard = ''
+        plan = self.plan
+        queryargs = self._queryargs()
         if etype == self.entity.cw_etype:
-            eids = (str(x) for x in (self.orig_container_eid, self.entity.eid))
-            guard = ', NOT X eid IN (%s)' % ','.join(eids)
-        # 1/ fetch all <etype> entities in current container
-        query, fetched_rtypes, inlined_rtypes = self._etype_fetch_rqlst(etype, guard)
-        candidates_rset = self._cw.execute(query, self._queryargs())
-        if not candidates_rset:
-            self.info('nothing to be cloned for %s', etype)
-            return {}
-
-        self.info('cloning %d %s BOs', len(candidates_rset.rows), etype)
+            # see ClonePlan.guard (batched clones filter the rows instead)
+            if self._batch_origs is None:
+                queryargs.update({'orig': self.orig_container_eid, 'clone': self.entity.eid})
+            else:
+                queryargs.update({'orig': 0, 'clone': 0})
+        fetched_rtypes = plan.fetched_rtypes[etype]
+        inlined_rtypes = plan.inlined_rtypes[etype]
 
-        relations = defaultdict(list)
+        relations = RelationBuffer()
         deferred_relations = []
 
+        # 1/ fetch all <etype> entities in current container
         # 2/ clone attributes / inlined relations
-        self._etype_create_clones(etype, orig_to_clone, candidates_rset,
-                                  relations, deferred_relations,
-                                  fetched_rtypes, inlined_rtypes)
+        count = 0
+        for rows in self._etype_fetch_pages(etype, queryargs):
+            count += len(rows)
+            self.metrics.fetched[etype] += len(rows)
+            self.info('cloning %d %s BOs', len(rows), etype)
+            with self.metrics.timed('insert'):
+                self._etype_create_clones(etype, orig_to_clone, rows,
+                                          relations, deferred_relations,
+                                          fetched_rtypes, inlined_rtypes)
+        if not count:
+            self.info('nothing to be cloned for %s', etype)
+            return relations
 
         # 3/ clone standard (i.e non-inlined) relations
-        self._etype_relink_clones(etype, self._queryargs(), relations, deferred_relations)
+        with self.metrics.timed('relink'):
+            self._etype_relink_clones(etype, self._queryargs(), relations, deferred_relations)
 
         # 4/ handle deferred relations
         self._flush_deferred(deferred_relations, orig_to_clone)
         return relations
 
+    def _etype_fetch_pages(self, etype, queryargs):
+        """ yield the non-empty rows lists of the fetch query, either
+        in one go or, if `clone_page_size` is set, by chunks of at most
+        `clone_page_size` rows ordered by eid (hence peak memory does
+        not depend on the container size)
+        """
+        page_size = self.clone_page_size
+        if not page_size:
+            with self.metrics.timed('fetch'):
+                rows = self._read(self._scoped(self.plan.fetch_rql[etype], etype), queryargs,
+                                  inner=True)
+            if rows:
+                yield rows
+            return
+        rql = self._scoped(self.plan.paged_fetch_rql(etype, page_size), etype)
+        queryargs = dict(queryargs, lasteid=0)
+        while True:
+            with self.metrics.timed('fetch'):
+                rows = self._read(rql, queryargs, inner=True)
+            if not rows:
+                return
+            yield rows
+            if len(rows) < page_size:
+                return
+            queryargs['lasteid'] = rows[-1][0]
+
     def _flush_deferred(self, deferred_relations, orig_to_clone):
         if len(deferred_relations):
             self.info('relinking deferred (%d relations)', len(deferred_relations))
             self.handle_special_relations((rtype, orig_to_clone[orig], linked)
                                           for rtype, orig, linked in deferred_relations)
 
+    def preprocess_batch(self, etype, oldeids, columns):
+        """ called with the original eids of a page of `etype` entities
+        and their clones attributes as `columns`, a dict from attribute
+        (or inlined rtype) to the list of values aligned with `oldeids`,
+        to be modified in place
+
+        Rather override this than `preprocess_attributes`: values may be
+        computed for the whole page at once (e.g. with one query).
+        """
+        pass
+
     def preprocess_attributes(self, etype, oldeid, attributes):
+        """ called for each clone with its `attributes` dict, after
+        `preprocess_batch` (kept for compatibility) """
         pass
 
+    @property
+    def _preprocess_rows(self):
+        """ tells whether `preprocess_attributes` is overridden """
+        return self._overridden('preprocess_attributes')
+
     def _crosses_border(self, etype, rtype):
         """ Tells whether the (etype, rtype, *) relation
         has ALL its targets outside of the container """
-        if rtype == 'container_parent':
-            # it is technically possible that it crosses the border
-            # but a container_parent, by design, is always an inner
-            # container relation
-            return False
-        schema = self._cw.vreg.schema
-        etypes = set(self._ordered_etypes)
-        etypes.add(self.entity.cw_etype)
-        return all(target not in etypes
-                   for target in schema[rtype].targets(etype))
+        return self.plan.crosses_border(etype, rtype)
 
     def _already_cloned(self, etype, rtype):
         """ Tells whether all targets in the (etype, rtype, TARGET)
         relation can have been already cloned """
-        # a shortcut for the container relation
-        if rtype == self.config.crtype:
-            return True
-        schema = self._cw.vreg.schema
-        ordered_etypes = self._ordered_etypes
-        try:
-            return all(ordered_etypes.index(etype) > ordered_etypes.index(target)
-                       for target in schema[rtype].targets(etype))
-        except ValueError:
-            # some target is not clonable
-            return False
+        return self.plan.already_cloned_targets(etype, rtype)
 
-    def _etype_create_clones(self, etype, orig_to_clone, candidates_rset,
+    def _etype_create_clones(self, etype, orig_to_clone, rows,
                              relations, deferred_relations,
                              fetched_rtypes, inlined_rtypes):
         entities = []
-        # detect inlined rtypes that may be already cloned
-        inlined_rtypes_already_cloned = set()
-        # detect inlined rtypes that have at least one
+        # inlined rtypes that may be already cloned
+        inlined_rtypes_already_cloned = set(self.plan.already_cloned[etype])
+        if self._subtree is not None:
+            # the targets may be out of the subtree: let the peek decide
+            inlined_rtypes_already_cloned &= set((self.config.crtype,))
+        # inlined rtypes that have at least one
         # out-of-container target
-        inlined_rtypes_crossing_border = set()
-
-        for rtype in fetched_rtypes:
-            if rtype in inlined_rtypes:
-                if self._crosses_border(etype, rtype):
-                    inlined_rtypes_crossing_border.add(rtype)
-                elif self._already_cloned(etype, rtype):
-                    inlined_rtypes_already_cloned.add(rtype)
+        inlined_rtypes_crossing_border = self.plan.crossing_border[etype]
 
         # Unfortunately, the above classification still can miss
         # opportunities, because the static analysis lacks relevant
         # information.
-        # Hence we peek the first rset row to determine if an inlined
+        # Hence we peek the first row to determine if an inlined
         # relation has been cloned, and if by chance it is valued
         # and appears to have a clone, we just avoided to send an inlined
         # relation to .add_relations (which performs horribly).
-        iterrows = iter(candidates_rset.rows)
+        inlined_rtypes_peeked = set()
+        if self._batch_origs is not None and etype == self.entity.cw_etype:
+            # the batched containers are already cloned (by their parent)
+            origs = set(self._batch_origs)
+            rows = [row for row in rows if row[0] not in origs]
+            if not rows:
+                return
+        iterrows = iter(rows)
         firstrow = iterrows.next()
         for rtype, val in zip(fetched_rtypes, firstrow[1:]):
             if rtype in inlined_rtypes:
                 if rtype in inlined_rtypes_crossing_border:
                     continue
                 if val in orig_to_clone:
-                    if rtype not in inlined_rtypes_crossing_border:
+                    if rtype not in inlined_rtypes_already_cloned:
+                        inlined_rtypes_peeked.add(rtype)
                         inlined_rtypes_already_cloned.add(rtype)
 
         # Let's gather some real-life info
@@ -469,9 +1243,12 @@ class ContainerClone(EntityAdapter):
                                               (inlined_rtypes_already_cloned |
                                                inlined_rtypes_crossing_border)))
 
+        # the attributes of the clones, as columns aligned with oldeids
+        oldeids = []
+        columns = defaultdict(list)
         for row in chain([firstrow], iterrows):
             oldeid = row[0]
-            attributes = {}
+            oldeids.append(oldeid)
             for rtype, val in zip(fetched_rtypes, row[1:]):
 
                 if rtype in inlined_rtypes:
@@ -486,47 +1263,126 @@ class ContainerClone(EntityAdapter):
 
                     if rtype in inlined_rtypes_already_cloned:
                         # there can be Nones here
-                        if val is not None:
-                            assert val in orig_to_clone
-                        attributes[rtype] = orig_to_clone.get(val)
+                        if val is not None and val not in orig_to_clone:
+                            # the peek was too optimistic (e.g. a self
+                            # referencing rtype whose target comes in a later
+                            # page): keep the attribute, link it afterwards
+                            assert rtype in inlined_rtypes_peeked
+                            relations.add(rtype, oldeid, val)
+                        columns[rtype].append(orig_to_clone.get(val))
                         continue
 
                     if rtype in inlined_rtypes_crossing_border:
                         # feed it right away
-                        attributes[rtype] = val
+                        columns[rtype].append(val)
                         continue
 
                     # deferred to relations (or nothing if None)
                     if val is not None:
-                        relations[rtype].append((oldeid, val))
+                        relations.add(rtype, oldeid, val)
                     continue
 
                 # standard attribute
-                attributes[rtype] = val
-
-            self.preprocess_attributes(etype, oldeid, attributes)
+                columns[rtype].append(val)
+
+        self.preprocess_batch(etype, oldeids, columns)
+        rtypes = columns.keys()
+        values = [columns[rtype] for rtype in rtypes]
+        preprocess_row = self._preprocess_rows
+        for idx, oldeid in enumerate(oldeids):
+            attributes = dict((rtype, rvalues[idx])
+                              for rtype, rvalues in izip(rtypes, values))
+            if preprocess_row:
+                self.preprocess_attributes(etype, oldeid, attributes)
             entities.append((attributes, oldeid))
 
+        # the controller creates the eids (and their entities table rows)
+        # itself, it can't be handed a block reserved beforehand
         def complete_orig_to_clone(entity, _attrs, oldeid):
             """ callback when a new eid has been produced """
             orig_to_clone[oldeid] = entity.eid
         self.controller.insert_entities(etype, entities, complete_orig_to_clone)
+        self.metrics.inserted[etype] += len(entities)
 
     def _etype_relink_clones(self, etype, queryargs, relations, deferred_relations):
-        etype_rql = self._complete_rql(etype)
-        for rtype in self.clonable_rtypes(etype):
-            self.info('  rtype %s', rtype)
-            # NOTE: use rqlst.save() / rqlst.recover() ?
-            etype_rqlst = parse(etype_rql).children[0]
-            # here, we've got something like: Any X WHERE X <container> C, ...
-            _add_rqlst_restriction(etype_rqlst, rtype)
-            # now, we've got something like: Any X,Y WHERE X <container> C, ..., X <rtype> Y
-            linked_rset = self._cw.execute(etype_rqlst, queryargs)
-            for ceid, linked_eid in linked_rset:
+        # the fused query is not paged
+        if (self.clone_fused_fetch and self._default_scope() and not self.clone_page_size
+                and self._batch_origs is None and self._subtree is None):
+            rows = self._etype_fused_relations(etype, queryargs)
+            for rtype, ceid, linked_eid in rows:
                 if rtype in self._specially_handled_rtypes:
                     deferred_relations.append((rtype, ceid, linked_eid))
                 else:
-                    relations[rtype].append((ceid, linked_eid))
+                    relations.add(rtype, ceid, linked_eid)
+            return
+        for rtype, rql in self.plan.relink_rql[etype]:
+            self.info('  rtype %s', rtype)
+            for rows in self._relink_pages(etype, rtype, rql, queryargs):
+                for ceid, linked_eid in rows:
+                    if rtype in self._specially_handled_rtypes:
+                        deferred_relations.append((rtype, ceid, linked_eid))
+                    else:
+                        relations.add(rtype, ceid, linked_eid)
+
+    def _relink_pages(self, etype, rtype, rql, queryargs):
+        """ yield the (subject, object) rows lists of the relink `rql` of
+        (`etype`, `rtype`), either in one go or, if `clone_page_size` is
+        set, by pages of at most `clone_page_size` rows ordered by subject
+        eid (as `_etype_fetch_pages`)
+
+        The links of a subject are never split between two pages: those of
+        the last subject of a full page are read again with the next page,
+        or on their own if they fill the page.
+        """
+        page_size = self.clone_page_size
+        if not page_size:
+            yield self._read(self._scoped(rql, etype), queryargs)
+            return
+        paged_rql, subject_rql = self.plan.paged_relink_rql(etype, rtype, page_size)
+        paged_rql = self._scoped(paged_rql, etype)
+        subject_rql = self._scoped(subject_rql, etype)
+        queryargs = dict(queryargs, lasteid=0)
+        while True:
+            rows = self._read(paged_rql, queryargs)
+            if len(rows) < page_size:
+                if rows:
+                    yield rows
+                return
+            last = rows[-1][0]
+            rows = [row for row in rows if row[0] != last]
+            if not rows:
+                rows = self._read(subject_rql, dict(queryargs, subject=last))
+            yield rows
+            queryargs['lasteid'] = rows[-1][0]
+
+    def _etype_fused_relations(self, etype, queryargs):
+        """ fetch all the (rtype, subject eid, object eid) links of the
+        clonable non-inlined rtypes of `etype` in the container, in one
+        single sql query
+
+        Rtypes which have no plain relation table (symmetric or computed
+        ones) are fetched with one rql query each.
+        """
+        cnx = self._cw
+        schema = cnx.vreg.schema
+        selects = []
+        rows = []
+        for rtype, _rql in self.plan.relink_rql[etype]:
+            rschema = schema[rtype]
+            if rschema.symmetric or getattr(rschema, 'rule', None):
+                rql = 'Any X,Y WHERE X is %s, X %s C, C eid %%(container)s, X %s Y' % (
+                    etype, self.config.crtype, rtype)
+                rows.extend((rtype, ceid, linked_eid)
+                            for ceid, linked_eid in self._read(rql, queryargs))
+                continue
+            selects.append("SELECT '%(rtype)s', rel.eid_from, rel.eid_to "
+                           "FROM %(rtype)s_relation AS rel, %(p)s%(etype)s AS x "
+                           "WHERE rel.eid_from=x.%(p)seid AND x.%(p)s%(crtype)s=%%(container)s"
+                           % {'rtype': rtype, 'etype': etype, 'p': SQL_PREFIX,
+                              'crtype': self.config.crtype})
+        if selects:
+            rows.extend(self._read(' UNION ALL '.join(selects), queryargs, sql=True))
+        return rows
 
     def _container_relink(self, orig_to_clone):
         """ handle subject relations of the container - this is
@@ -537,34 +1393,42 @@ class ContainerClone(EntityAdapter):
         * those that must yet be cloned
         """
         deferred_relations = []
-        relations = defaultdict(list)
+        relations = RelationBuffer()
         queryargs = self._queryargs()
         clone = self.entity
-        etype = clone.e_schema.type
-        etype_rql = 'Any X WHERE X is %s, X eid %s' % (
-                etype, self.orig_container_eid)
-        skiprtypes = set(self.rtypes_to_skip)
-        if self.clone_rtype:
-            skiprtypes.add(self.clone_rtype)
         clone_subject_relations = set(rschema.type
                                       for rschema in clone.e_schema.subject_relations()
                                       if not rschema.final)
-        for rtype in self.clonable_rtypes(etype):
+        for rtype, rql, existsrql in self.plan.container_relink_rql:
             if rtype in clone_subject_relations:
-                if self._cw.execute('Any Y LIMIT 1 WHERE X eid %%(clone)s, X %(rtype)s Y'
-                                    % {'rtype': rtype}, {'clone': clone.eid}):
+                if self._cw.execute(existsrql, {'clone': clone.eid}):
                     continue
-            etype_rqlst = parse(etype_rql).children[0]
-            _add_rqlst_restriction(etype_rqlst, rtype)
-            linked_rset = self._cw.execute(etype_rqlst, queryargs)
-            for ceid, linked_eid in linked_rset:
+            for ceid, linked_eid in self._read(rql, queryargs):
                 if rtype in self._specially_handled_rtypes:
                     deferred_relations.append((rtype, ceid, linked_eid))
                 else:
-                    relations[rtype].append((ceid, linked_eid))
+                    relations.add(rtype, ceid, linked_eid)
         self._flush_deferred(deferred_relations, orig_to_clone)
         return relations
 
+    def _read(self, query, queryargs=None, sql=False, inner=False):
+        """ the rows of an rql (or `sql`) query on the original container,
+        taken from its snapshot if possible (`inner` tells whether the
+        first column holds entities of the container) """
+        cnx = self._cw
+
+        def execute():
+            if sql:
+                return cnx.system_sql(query, queryargs).fetchall()
+            return cnx.execute(query, queryargs).rows
+        if self._snapshot is None:
+            return execute()
+        # the clone eid (see ClonePlan.guard) is not part of the read
+        key = (query, tuple(sorted((name, value)
+                                   for name, value in (queryargs or {}).iteritems()
+                                   if name != 'clone')))
+        return self._snapshot.read(key, execute, inner)
+
     @cachedproperty
     def _specially_handled_rtypes(self):
         """ rtypes in this set will not be handled by the default
@@ -586,6 +1450,13 @@ class MultiParentProtocol(EntityAdapter):
     def possible_parent(self, rtype, eid):
         pass
 
+    def possible_parents(self, rtype_eids):
+        """ the batch variant of `possible_parent`, called before commit
+        with the (rtype, eid) parents added after the first one to an
+        entity created in the transaction """
+        for rtype, eid in rtype_eids:
+            self.possible_parent(rtype, eid)
+
 
 def registration_callback(vreg):
     vreg.register_all(globals().values(), __name__)
@@ -594,6 +1465,7 @@ def registration_callback(vreg):
 
     @onevent('after-registry-reload')
     def register_container_adapters():
+        _CLONE_PLANS.clear()
         for adapter in Container.container_adapters(vreg.schema):
             if adapter.__regid__ not in vreg[adapter.__registry__]:
                 vreg.register(adapter)
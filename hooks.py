@@ -15,57 +15,125 @@
 # with this program. If not, see <http://www.gnu.org/licenses/>.
 
 """cubicweb-container specific hooks and operations"""
-from collections import defaultdict
+from collections import defaultdict, deque
+from functools import partial
+from weakref import WeakKeyDictionary
 
 from logilab.common.deprecation import class_deprecated
-from logilab.common.registry import Predicate
+from logilab.common.registry import Predicate, objectify_predicate
 
 from cubicweb import ValidationError, onevent
 from cubicweb.server.hook import Hook, DataOperationMixIn, Operation
 from cubicweb.server.session import Connection
 
-from cubes.container.utils import parent_rschemas
+from cubes.container.utils import bulk_set_inlined, eids_etypes, parent_rschemas
 from cubes.container.config import Container, clear_callback
+from cubes.container.jobs import CloneJobRunner, fulltext_index
+from cubes.container.snapshot import has_snapshots, invalidate_snapshots
 
 
 def eid_etype(cnx, eid):
-    return cnx.entity_metas(eid)['type']
+    """ the etype of `eid`, cached in the transaction data (entities
+    already in the transaction entity cache cost nothing) """
+    etypes = cnx.transaction_data.setdefault('container.eid_etype', {})
+    try:
+        return etypes[eid]
+    except KeyError:
+        pass
+    try:
+        etype = cnx.entity_cache(eid).cw_etype
+    except KeyError:
+        etype = cnx.entity_metas(eid)['type']
+    etypes[eid] = etype
+    return etype
+
+
+# repository -> {etype name: CWEType eid}, cleared on registry reload
+_CWETYPE_EIDS = WeakKeyDictionary()
+
+
+def cwetype_eid(cnx, etype):
+    """ the eid of the CWEType entity of `etype`, cached for the lifetime of
+    the repository schema (usually known by the schema, else queried once) """
+    cache = _CWETYPE_EIDS.setdefault(cnx.repo, {})
+    try:
+        return cache[etype]
+    except KeyError:
+        pass
+    eid = cnx.vreg.schema[etype].eid
+    if eid is None:
+        with cnx.security_enabled(read=False):
+            eid = cnx.execute('CWEType T WHERE T name %(name)s',
+                              {'name': unicode(etype)}).rows[0][0]
+    cache[etype] = eid
+    return eid
+
+
+def eids_etypes_cached(cnx, eids):
+    """ return a dict mapping `eids` to their etype, like eid_etype but
+    with one query for all those not yet in the transaction cache """
+    etypes = cnx.transaction_data.setdefault('container.eid_etype', {})
+    result = {}
+    unknown = []
+    for eid in eids:
+        if eid in etypes:
+            result[eid] = etypes[eid]
+            continue
+        try:
+            result[eid] = etypes[eid] = cnx.entity_cache(eid).cw_etype
+        except KeyError:
+            unknown.append(eid)
+    fetched = eids_etypes(cnx, unknown)
+    etypes.update(fetched)
+    result.update(fetched)
+    return result
 
 
 class match_rdefs(Predicate):
     """A selector to match relation definitions provided as yams relation
     definition objects.
+
+    The relation types and (rtype, subject etype, object etype) triples
+    are frozen at instantiation: other rtypes are rejected without
+    looking at the eids.
     """
 
     def __init__(self, *rdefs):
-        self.expected = defaultdict(set)
-        for rdef in rdefs:
-            self.expected[rdef.rtype.type].add((rdef.subject.type,
-                                                rdef.object.type))
+        self.triples = frozenset((rdef.rtype.type, rdef.subject.type, rdef.object.type)
+                                 for rdef in rdefs)
+        self.rtypes = frozenset(rtype for rtype, _subj, _obj in self.triples)
 
     def __str__(self):
-        expanded = []
-        for rtype, from_to in self.expected.iteritems():
-            for efrom, eto in from_to:
-                expanded.append('%s-%s-%s' % (rtype, efrom, eto))
-        return '%s(%s)' % (self.__class__.__name__, ','.join(sorted(expanded)))
+        return '%s(%s)' % (self.__class__.__name__,
+                           ','.join(sorted('%s-%s-%s' % triple for triple in self.triples)))
 
     def __call__(self, cls, req, *args, **kwargs):
         rtype = kwargs.get('rtype')
-        if rtype not in self.expected:
+        if rtype not in self.rtypes:
             return 0
-        subjetype = eid_etype(req, kwargs['eidfrom'])
-        objetype = eid_etype(req, kwargs['eidto'])
-        if (subjetype, objetype) in self.expected[rtype]:
+        if (rtype, eid_etype(req, kwargs['eidfrom']),
+                eid_etype(req, kwargs['eidto'])) in self.triples:
             return 1
         return 0
 
 
-def entity_and_parent(cnx, eidfrom, rtype, eidto, etypefrom, etypeto):
+@objectify_predicate
+def clone_snapshots_enabled(cls, req, **kwargs):
+    """ predicate telling whether some container keeps clone snapshots
+    (see Container.clone_snapshot) """
+    return int(any(Container.by_etype(cetype).clone_snapshot
+                   for cetype in Container.all_etypes()))
+
+
+def entity_and_parent(cnx, eidfrom, rtype, eidto, etypefrom=None, etypeto=None):
     """ given a triple (eidfrom, rtype, eidto)
     where one of the two eids is the parent of the other,
     compute a return (eid, eidparent)
     """
+    if etypefrom is None:
+        etypefrom = eid_etype(cnx, eidfrom)
+    if etypeto is None:
+        etypeto = eid_etype(cnx, eidto)
     crole = cnx.vreg.schema[rtype].rdef(etypefrom, etypeto).composite
     if crole == 'object':
         return eidfrom, eidto
@@ -80,31 +148,90 @@ def find_valued_parent_rtype(entity, but):
             return rschema.type
 
 def _set_container_parent(cnx, rtype, eid, peid):
-    target = cnx.entity_from_eid(eid)
-    if target.container_parent:
-        mp_protocol = target.cw_adapt_to('container.multiple_parents')
-        if mp_protocol:
+    """ set the container_parent of `eid` to `peid` (through `rtype`)
+
+    The first parent of an entity created in the transaction is recorded
+    and set in bulk before commit by SetContainerParentOp; the others
+    (and the relinks of existing entities) are validated at once. Once the
+    commit has started (e.g. relations added by a precommit operation,
+    maybe after SetContainerParentOp ran), the parent is set at once.
+    """
+    pending = cnx.transaction_data.setdefault('container.pending_parents', {})
+    target = cnx.entity_from_eid(eid, eid_etype(cnx, eid))
+    if eid in pending:
+        cparent_eid = pending[eid][0][1]
+    elif target.container_parent:
+        cparent_eid = target.container_parent[0].eid
+    elif cnx.added_in_transaction(eid) and cnx.commit_state is None:
+        pending[eid] = [(rtype, peid)]
+        SetContainerParentOp.get_instance(cnx).add_data(eid)
+        return
+    else:
+        target.cw_set(container_parent=peid)
+        return
+    mp_protocol = target.cw_adapt_to('container.multiple_parents')
+    if mp_protocol:
+        if eid in pending:
+            pending[eid].append((rtype, peid))
+        else:
             mp_protocol.possible_parent(rtype, peid)
-            return
-        cparent = target.container_parent[0]
-        if cparent.eid == peid:
-            cnx.warning('relinking %s (eid:%s parent:%s)', rtype, eid, peid)
-            return
-        # this is a replacement: we allow replacing within the same container
-        #                        for the same rtype
-        other_rtype = find_valued_parent_rtype(target, but=rtype)
-        if other_rtype:
+        return
+    if cparent_eid == peid:
+        cnx.warning('relinking %s (eid:%s parent:%s)', rtype, eid, peid)
+        return
+    # this is a replacement: we allow replacing within the same container
+    #                        for the same rtype
+    other_rtype = find_valued_parent_rtype(target, but=rtype)
+    if other_rtype:
+        if eid in pending:
+            cparent = cnx.entity_from_eid(cparent_eid)
+            container = cparent.cw_adapt_to('Container').related_container
+        else:
             container = target.cw_adapt_to('Container').related_container
-            parent = cnx.entity_from_eid(peid)
-            parent_container = parent.cw_adapt_to('Container').related_container
-            if container.eid != parent_container.eid or rtype != other_rtype:
-                cnx.warning('%s is already in container %s, cannot go into %s '
-                            ' (rtype from: %s, rtype to: %s)',
-                            target, parent_container, container, other_rtype, rtype)
-                msg = (cnx._('%s is already in a container through %s') %
-                       (target.e_schema, rtype))
-                raise ValidationError(target.eid, {rtype: msg})
-    target.cw_set(container_parent=peid)
+        parent = cnx.entity_from_eid(peid)
+        parent_container = parent.cw_adapt_to('Container').related_container
+        if container.eid != parent_container.eid or rtype != other_rtype:
+            cnx.warning('%s is already in container %s, cannot go into %s '
+                        ' (rtype from: %s, rtype to: %s)',
+                        target, parent_container, container, other_rtype, rtype)
+            msg = (cnx._('%s is already in a container through %s') %
+                   (target.e_schema, rtype))
+            raise ValidationError(target.eid, {rtype: msg})
+    if eid in pending:
+        pending[eid] = [(rtype, peid)]
+    else:
+        target.cw_set(container_parent=peid)
+
+
+class SetContainerParentOp(DataOperationMixIn, Operation):
+    """ set the container_parent of the entities created in the transaction
+    (see _set_container_parent) with bulk updates, then hand their other
+    parents to their `container.multiple_parents` adapter """
+
+    def insert_index(self):
+        """ we schedule ourselve ahead of all other operations: the
+        container relation and new container operations use the parents """
+        return 0
+
+    def precommit_event(self):
+        cnx = self.cnx
+        pending = cnx.transaction_data.pop('container.pending_parents', {})
+        subjects, objects = [], []
+        for eid in sorted(self.get_data()):
+            if eid not in pending or cnx.deleted_in_transaction(eid):
+                continue
+            peid = pending[eid][0][1]
+            if cnx.deleted_in_transaction(peid):
+                continue
+            subjects.append(eid)
+            objects.append(peid)
+        if subjects:
+            bulk_set_inlined(cnx, 'container_parent', subjects, objects)
+        for eid in subjects:
+            others = pending[eid][1:]
+            if others:
+                target = cnx.entity_from_eid(eid, eid_etype(cnx, eid))
+                target.cw_adapt_to('container.multiple_parents').possible_parents(others)
 
 
 class SetContainerRelation(Hook):
@@ -187,34 +314,94 @@ class AddContainerRelationOp(DataOperationMixIn, Operation):
     """ when all relations are set, we set <container> """
 
     def insert_index(self):
-        """ we schedule ourselve ahead of all other operations """
+        """ we schedule ourselve ahead of all other operations but the
+        container_parent one """
+        for idx, op in enumerate(self.cnx.pending_operations):
+            if isinstance(op, SetContainerParentOp):
+                return idx + 1
         return 0
 
-    def _container_cwetype_eid(self, container, cwetype_eid_map):
-        etype = container.e_schema.type
-        if etype in cwetype_eid_map:
-            return cwetype_eid_map[etype]
-        eid = self.cnx.execute('CWEType T WHERE T name %(name)s',
-                               {'name': unicode(etype)}).rows[0][0]
-        cwetype_eid_map[etype] = eid
-        return eid
+    def _committed_containers(self, eids, etypes, batchsize=1000):
+        """ eid -> container eid of those of `eids` whose container relation
+        is already set, with one query per container etype and batch of
+        `batchsize` eids
+
+        As in `related_container`, the container relation followed is the
+        one of the `container_etype` of the entity (an entity may belong
+        to several containers).
+        """
+        cnx = self.cnx
+        schema = cnx.vreg.schema
+        containers = {}
+        with cnx.security_enabled(read=False):
+            for cetype in sorted(Container.all_etypes()):
+                crtype = Container.by_etype(cetype).crtype
+                subjetypes = set(eschema.type for eschema in schema[crtype].subjects())
+                subjects = sorted(eid for eid in eids if etypes[eid] in subjetypes)
+                for start in xrange(0, len(subjects), batchsize):
+                    rset = cnx.execute(
+                        'Any X,C WHERE X %s C, X container_etype ET, ET eid %%(et)s, '
+                        'X eid IN (%s)' % (crtype, ','.join(
+                            str(eid) for eid in subjects[start:start + batchsize])),
+                        {'et': cwetype_eid(cnx, cetype)})
+                    containers.update(rset.rows)
+        return containers
+
+    def _resolve_containers(self, pairs, etypes):
+        """ return a dict mapping the eids of `pairs` (a list of (eid,
+        peid)) to the eid of their container, when it can be reached
+
+        The parents that are containers map to themselves and those whose
+        container relation is already set are resolved in bulk; then the
+        containers are pushed down the pairs to the entities added in the
+        transaction until a fixpoint is reached, whatever the order in
+        which the relations were added.
+        """
+        cetypes = Container.all_etypes()
+        children = defaultdict(list)
+        for eid, peid in pairs:
+            children[peid].append(eid)
+        containers = {}
+        for peid in children:
+            if etypes[peid] in cetypes:
+                containers[peid] = peid
+        containers.update(self._committed_containers(
+            [peid for peid in children if peid not in containers], etypes))
+        etypes.update(eids_etypes_cached(self.cnx, set(containers.itervalues())))
+        queue = deque(containers)
+        while queue:
+            peid = queue.popleft()
+            ceid = containers[peid]
+            skipetypes = Container.by_etype(etypes[ceid]).skipetypes
+            for eid in children.get(peid, ()):
+                if eid in containers or etypes[eid] in skipetypes:
+                    continue
+                containers[eid] = ceid
+                queue.append(eid)
+        return containers
 
     def precommit_event(self):
-        cwetype_eid_map = {}
         cnx = self.cnx
+        pairs = list(self.get_data())
+        etypes = eids_etypes_cached(cnx, set(eid for pair in pairs for eid in pair))
+        containers = self._resolve_containers(pairs, etypes)
         container_rtype_rel = defaultdict(list)
         container_etype_rel = []
-        for eid, peid in self.get_data():
-            parent = cnx.entity_from_eid(peid)
-            cprotocol = parent.cw_adapt_to('Container')
-            container = cprotocol.related_container
-            if container is None:
-                self.critical('container entity could not be reached from %s, '
-                              'you may have ordering issues', parent)
-                continue
-            cconf = Container.by_etype(container.cw_etype)
-            container_rtype_rel[cconf.crtype].append((eid, container.eid))
-            container_etype_rel.append((eid, self._container_cwetype_eid(container, cwetype_eid_map)))
+        for eid, peid in pairs:
+            ceid = containers.get(peid)
+            if ceid is None:
+                # not reachable from the pairs, let the parent find its way
+                parent = cnx.entity_from_eid(peid, etypes[peid])
+                container = parent.cw_adapt_to('Container').related_container
+                if container is None:
+                    self.critical('container entity could not be reached from %s, '
+                                  'you may have ordering issues', parent)
+                    continue
+                ceid = container.eid
+                etypes[ceid] = container.cw_etype
+            cconf = Container.by_etype(etypes[ceid])
+            container_rtype_rel[cconf.crtype].append((eid, ceid))
+            container_etype_rel.append((eid, cwetype_eid(cnx, etypes[ceid])))
         if container_rtype_rel:
             cnx.add_relations(container_rtype_rel.items())
         if container_etype_rel:
@@ -222,44 +409,141 @@ class AddContainerRelationOp(DataOperationMixIn, Operation):
 
 # clone using <clone_relation> Hook & Operation
 
-class CloneContainer(Hook):
-    __regid__ = 'container.clone'
-    __abstract__ = True
-    category = 'container'
-    events = ('after_add_relation',)
-    # __select__ = match_rtype(container_clone_rtype)
-
-    def __call__(self):
-        CloneContainerOp.get_instance(self._cw).add_data(self.eidfrom)
-
-
 class CloneContainerOp(DataOperationMixIn, Operation):
+    """ clone the containers given as data once the transaction is
+    committed, or queue a CloneJob for those whose container is cloned
+    in the background
+
+    The CloneJob records the operation class, whose `clone_container` is
+    used by the background runner: the clone hooks below are classmethods.
+    """
 
-    def prepare_cloned_container(self, cnx, clone):
+    @classmethod
+    def prepare_cloned_container(cls, cnx, clone):
         """ give a chance to cleanup cloned container before the process starts
         e.g.: it may already have a workflow state but we want to ensure it has none
         before it is entirely cloned
         """
         pass
 
+    def precommit_event(self):
+        self.background = set()
+        cnx = self.cnx
+        operation = u'%s.%s' % (self.__class__.__module__, self.__class__.__name__)
+        for cloneid in self.get_data():
+            if Container.by_etype(eid_etype(cnx, cloneid)).clone_in_background:
+                self.background.add(cloneid)
+                with cnx.security_enabled(read=False, write=False):
+                    cnx.create_entity('CloneJob', clone_eid=cloneid, operation=operation)
+
     def postcommit_event(self):
         for cloneid in self.get_data():
+            if cloneid in self.background:
+                continue
             with Connection(self.cnx.repo, self.cnx.user) as cnx:
-                cloned = cnx.entity_from_eid(cloneid)
-                config = Container.by_etype(cloned.cw_etype)
-                with cnx.deny_all_hooks_but(*config.compulsory_hooks_categories):
-                    self.prepare_cloned_container(cnx, cloned)
-                    cloned.cw_adapt_to('Container.clone').clone()
-                    self.finalize_cloned_container(cnx, cloned)
-                    cnx.commit()
-
-    def finalize_cloned_container(self, cnx, clone):
+                self.clone_container(cnx, cloneid)
+
+    @classmethod
+    def clone_container(cls, cnx, cloneid, before_commit=None):
+        """ clone into the container `cloneid` and commit, after having
+        called `before_commit` (if any) with the connection and cloner """
+        cloned = cnx.entity_from_eid(cloneid)
+        config = Container.by_etype(cloned.cw_etype)
+        with cnx.deny_all_hooks_but(*config.compulsory_hooks_categories):
+            cls.prepare_cloned_container(cnx, cloned)
+            cloner = cloned.cw_adapt_to('Container.clone')
+            cloner.clone()
+            cls.finalize_cloned_container(cnx, cloned)
+            if before_commit is not None:
+                before_commit(cnx, cloner)
+            cnx.commit()
+
+    @classmethod
+    def finalize_cloned_container(cls, cnx, clone):
         """ give a chance to cleanup cloned container after the cloning
         (can be useful for various hooks)
         """
         pass
 
 
+class CloneContainer(Hook):
+    __regid__ = 'container.clone'
+    __abstract__ = True
+    category = 'container'
+    events = ('after_add_relation',)
+    # __select__ = match_rtype(container_clone_rtype)
+    # the CloneContainerOp (sub)class running the clones
+    operation = CloneContainerOp
+
+    def __call__(self):
+        self.operation.get_instance(self._cw).add_data(self.eidfrom)
+
+
+class InvalidateCloneSnapshots(Hook):
+    """ record the eids of the changed entities and relations, whose
+    clone snapshots (see ContainerClone.clone_snapshot) must be dropped
+
+    The hook is only selected when some container configuration enables
+    `clone_snapshot`. The eids are then recorded even when no snapshot is
+    held: one may be taken before the transaction is committed. Only the
+    snapshots of this process are invalidated: instances sharing their
+    database should not use them.
+    """
+    __regid__ = 'container.invalidate-clone-snapshots'
+    __select__ = Hook.__select__ & clone_snapshots_enabled()
+    events = ('after_update_entity', 'after_delete_entity',
+              'after_add_relation', 'after_delete_relation')
+    category = 'container'
+
+    def __call__(self):
+        op = InvalidateCloneSnapshotsOp.get_instance(self._cw)
+        if self.event.endswith('_entity'):
+            op.add_data(self.entity.eid)
+        else:
+            op.add_data(self.eidfrom)
+            op.add_data(self.eidto)
+
+
+class InvalidateCloneSnapshotsOp(DataOperationMixIn, Operation):
+    """ drop the clone snapshots involving the eids given as data """
+
+    def postcommit_event(self):
+        if has_snapshots():
+            invalidate_snapshots(self.get_data())
+
+    def rollback_event(self):
+        # a snapshot may have been taken from the rollbacked state
+        if has_snapshots():
+            invalidate_snapshots(self.get_data())
+
+
+class FTIndexClonesOp(DataOperationMixIn, Operation):
+    """ full text index the cloned entities given as data in a thread,
+    once the clone is committed (see ContainerClone.clone_fulltext_index) """
+
+    def postcommit_event(self):
+        repo = self.cnx.repo
+        repo.threaded_task(partial(fulltext_index, repo, sorted(self.get_data())))
+
+
+class StartCloneJobs(Hook):
+    """ start the background clone workers, if any container wants them """
+    __regid__ = 'container.start-clone-jobs'
+    events = ('server_startup',)
+
+    def __call__(self):
+        if not any(Container.by_etype(cetype).clone_in_background
+                   for cetype in Container.all_etypes()):
+            return
+        repo = self.repo
+        # the jobs interrupted by a shutdown or a crash are queued again by
+        # the runner once their heartbeat expired: other instances may be
+        # running the others; each job is run by the operation class which
+        # queued it (a CloneContainerOp subclass)
+        runner = CloneJobRunner(repo, CloneContainerOp)
+        repo.looping_task(repo.config['container-clone-interval'], runner.dispatch)
+
+
 def registration_callback(vreg):
     vreg.register_all(globals().values(), __name__)
 
@@ -267,6 +551,9 @@ def registration_callback(vreg):
 
     @onevent('after-registry-reload')
     def register_container_hooks():
+        # the snapshots rows and the CWEType eids depend on the schema
+        invalidate_snapshots()
+        _CWETYPE_EIDS.clear()
         for hook in Container.container_hooks(vreg.schema):
             if hook.__regid__ not in vreg[hook.__registry__]:
                 vreg.register(hook)
@@ -0,0 +1,197 @@
+# copyright 2015 LOGILAB S.A. (Paris, FRANCE), all rights reserved.
+# contact http://www.logilab.fr -- mailto:contact@logilab.fr
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""cubicweb-container background clone jobs"""
+import json
+import logging
+import os
+import socket
+import traceback
+from datetime import datetime, timedelta
+from functools import partial
+from threading import Lock
+from uuid import uuid4
+
+from cubicweb.server.session import Connection
+from cubicweb.server.sqlutils import SQL_PREFIX
+
+from cubes.container.utils import fti_index_eids
+
+
+logger = logging.getLogger('cubes.container')
+
+
+def fulltext_index(repo, eids):
+    """ index the `eids` entities (see utils.fti_index_eids) in their own
+    transaction, e.g. in a thread once a clone is committed """
+    with repo.internal_cnx() as cnx:
+        count = fti_index_eids(cnx, eids)
+        cnx.commit()
+    logger.info('full text indexed %s cloned entities', count)
+
+
+def operation_class(base, name):
+    """ the `base` class or the loaded subclass of `base` whose dotted name
+    is `name` (the last loaded one, in case of reloads) """
+    found = base if name in (None, u'%s.%s' % (base.__module__, base.__name__)) else None
+    pending = [base]
+    while pending:
+        cls = pending.pop()
+        for subclass in cls.__subclasses__():
+            if u'%s.%s' % (subclass.__module__, subclass.__name__) == name:
+                found = subclass
+            pending.append(subclass)
+    if found is None:
+        raise ValueError('unknown clone operation %s' % name)
+    return found
+
+
+def job_user(cnx, eid):
+    """ the CWUser `eid`, with its groups and properties loaded so that it
+    may be given to a Connection once `cnx` is closed """
+    user = cnx.entity_from_eid(eid, 'CWUser')
+    # pylint: disable=W0104
+    user.login
+    user.groups
+    user.properties
+    return user
+
+
+class CloneJobRunner(object):
+    """ run the queued CloneJob entities, at most `workers` at once
+
+    `dispatch` is meant to be a looping task of the repository: it claims
+    queued jobs while there are idle workers and runs each of them in its
+    own thread. A failed job is queued again until it has been attempted
+    `max_attempts` times.
+
+    Several instances may share the database: a claimed job is owned by
+    the runner, which refreshes its heartbeat on each dispatch. The jobs
+    whose heartbeat is older than `heartbeat_timeout` (their instance
+    crashed or was stopped) are queued again.
+
+    Jobs are run by the `clone_container` of the operation class recorded
+    on them (`operation` or one of its subclasses, see `operation_class`),
+    as the synchronous clones would be.
+    """
+
+    def __init__(self, repo, operation, workers=None, max_attempts=None,
+                 heartbeat_timeout=None):
+        self.repo = repo
+        self.operation = operation
+        self.workers = workers or repo.config['container-clone-workers']
+        self.max_attempts = max_attempts or repo.config['container-clone-max-attempts']
+        self.heartbeat_timeout = timedelta(seconds=heartbeat_timeout or
+                                           repo.config['container-clone-heartbeat-timeout'])
+        self.owner = u'%s:%s:%s' % (socket.gethostname(), os.getpid(), uuid4().hex)
+        self._running = set()
+        self._lock = Lock()
+
+    def dispatch(self):
+        """ report the running jobs, queue again the stale ones and start as
+        many queued jobs as there are idle workers """
+        with self._lock:
+            with self.repo.internal_cnx() as cnx:
+                self.heartbeat(cnx)
+                self.requeue_stale(cnx)
+                cnx.commit()
+            idle = self.workers - len(self._running)
+            if idle <= 0:
+                return
+            with self.repo.internal_cnx() as cnx:
+                rset = cnx.execute('Any J ORDERBY J LIMIT %d '
+                                   'WHERE J is CloneJob, J status "queued"' % idle)
+                jobeids = [jobeid for jobeid, in rset if self.claim(cnx, jobeid)]
+                cnx.commit()
+            for jobeid in jobeids:
+                self._running.add(jobeid)
+                self.repo.threaded_task(partial(self._run_in_thread, jobeid))
+
+    def claim(self, cnx, jobeid):
+        """ atomically move a queued job to the running status, owned by
+        this runner (several instances may share the database) """
+        cursor = cnx.system_sql("UPDATE %(p)sCloneJob SET %(p)sstatus='running', "
+                                "%(p)sowner=%%(owner)s, %(p)sheartbeat=%%(now)s "
+                                "WHERE %(p)seid=%%(eid)s AND %(p)sstatus='queued'"
+                                % {'p': SQL_PREFIX},
+                                {'eid': jobeid, 'owner': self.owner,
+                                 'now': datetime.utcnow()})
+        return cursor.rowcount == 1
+
+    def heartbeat(self, cnx):
+        """ report the jobs run by this runner as still running """
+        if not self._running:
+            return
+        cnx.system_sql("UPDATE %(p)sCloneJob SET %(p)sheartbeat=%%(now)s "
+                       "WHERE %(p)sowner=%%(owner)s AND %(p)sstatus='running' "
+                       "AND %(p)seid IN (%(eids)s)"
+                       % {'p': SQL_PREFIX,
+                          'eids': ','.join(str(int(eid)) for eid in self._running)},
+                       {'owner': self.owner, 'now': datetime.utcnow()})
+
+    def requeue_stale(self, cnx):
+        """ queue again the running jobs whose owner stopped reporting
+        them; return their number """
+        cursor = cnx.system_sql("UPDATE %(p)sCloneJob SET %(p)sstatus='queued', "
+                                "%(p)sowner=NULL "
+                                "WHERE %(p)sstatus='running' AND (%(p)sheartbeat IS NULL "
+                                "OR %(p)sheartbeat < %%(limit)s)" % {'p': SQL_PREFIX},
+                                {'limit': datetime.utcnow() - self.heartbeat_timeout})
+        if cursor.rowcount > 0:
+            logger.warning('%s stale clone jobs queued again', cursor.rowcount)
+        return cursor.rowcount
+
+    def _run_in_thread(self, jobeid):
+        try:
+            self.run_job(jobeid)
+        finally:
+            with self._lock:
+                self._running.discard(jobeid)
+
+    def run_job(self, jobeid):
+        """ run the claimed job `jobeid` on behalf of the user who queued it """
+        repo = self.repo
+        with repo.internal_cnx() as cnx:
+            job = cnx.entity_from_eid(jobeid)
+            cloneid = job.clone_eid
+            attempts = job.attempts + 1
+            operation = job.operation
+            user = job_user(cnx, job.created_by[0].eid)
+        logger.info('clone job %s: cloning into %s (attempt %s)', jobeid, cloneid, attempts)
+
+        def job_done(cnx, cloner):
+            # in the last transaction of the clone
+            with cnx.security_enabled(read=False, write=False):
+                cnx.entity_from_eid(jobeid).cw_set(
+                    status=u'done', attempts=attempts,
+                    metrics=unicode(json.dumps(cloner.metrics.as_dict())))
+
+        with Connection(repo, user) as cnx:
+            try:
+                operation_class(self.operation, operation).clone_container(
+                    cnx, cloneid, job_done)
+            except Exception:
+                error = unicode(traceback.format_exc(), 'utf-8', 'replace')
+                cnx.rollback()
+                logger.exception('clone job %s failed', jobeid)
+                self._failed(jobeid, attempts, error)
+
+    def _failed(self, jobeid, attempts, error):
+        status = u'queued' if attempts < self.max_attempts else u'failed'
+        with self.repo.internal_cnx() as cnx:
+            cnx.entity_from_eid(jobeid).cw_set(status=status, attempts=attempts,
+                                               error=error, owner=None)
+            cnx.commit()
@@ -0,0 +1,125 @@
+# copyright 2015 LOGILAB S.A. (Paris, FRANCE), all rights reserved.
+# contact http://www.logilab.fr -- mailto:contact@logilab.fr
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""cubicweb-container chunked clones progress journal"""
+from cubes.container.utils import EidMap, RelationBuffer
+
+
+# run once, by the postcreate script or the 3.1.0 migration
+JOURNAL_SQL = (
+    # steps done by a chunked clone ('started' until it is finished)
+    'CREATE TABLE container_clone_steps ('
+    ' clone INTEGER NOT NULL, step VARCHAR(256) NOT NULL)',
+    'CREATE INDEX container_clone_steps_clone_idx ON container_clone_steps (clone)',
+    # orig -> clone eids mapping of a chunked clone
+    'CREATE TABLE container_clone_mapping ('
+    ' clone INTEGER NOT NULL, orig INTEGER NOT NULL, copy INTEGER NOT NULL)',
+    'CREATE INDEX container_clone_mapping_clone_idx ON container_clone_mapping (clone)',
+    # collected links (between original eids) not yet inserted
+    'CREATE TABLE container_clone_links ('
+    ' clone INTEGER NOT NULL, rtype VARCHAR(64) NOT NULL,'
+    ' eid_from INTEGER NOT NULL, eid_to INTEGER NOT NULL)',
+    'CREATE INDEX container_clone_links_clone_idx ON container_clone_links (clone)',
+)
+
+
+class JournaledEidMap(EidMap):
+    """ an EidMap remembering the entries set since the last `flushed` """
+
+    def __init__(self, mapping=()):
+        self.pending = []
+        super(JournaledEidMap, self).__init__(mapping)
+        self.pending = []
+
+    def __setitem__(self, key, value):
+        self._set(key, value)
+        self.pending.append((key, value))
+
+    def flushed(self):
+        pending, self.pending = self.pending, []
+        return pending
+
+
+class CloneJournal(object):
+    """ the progress of the chunked clone into container `clone_eid`
+
+    The journal is kept in plain sql tables (see JOURNAL_SQL) and
+    written in the transaction of each checkpoint of the clone, hence a
+    failed clone may be resumed from its last checkpoint: the mapping is
+    reloaded, done steps are skipped and the links collected so far are
+    inserted at the end.
+    """
+
+    def __init__(self, cnx, clone_eid):
+        self.cnx = cnx
+        self.clone = clone_eid
+        self.steps = set(step for step, in self._sql(
+            'SELECT step FROM container_clone_steps WHERE clone=%(clone)s').fetchall())
+
+    def _sql(self, sql, args=None):
+        return self.cnx.system_sql(sql, dict(args or {}, clone=self.clone))
+
+    def _execmany(self, sql, args):
+        if args:
+            cnx = self.cnx
+            cnx.repo.system_source.doexecmany(cnx, sql, args)
+
+    @staticmethod
+    def incomplete(cnx, clone_eid):
+        """ tells whether a chunked clone into `clone_eid` was started but
+        is not finished """
+        return bool(cnx.system_sql("SELECT 1 FROM container_clone_steps "
+                                   "WHERE clone=%(clone)s AND step='started'",
+                                   {'clone': clone_eid}).fetchall())
+
+    def mapping(self):
+        """ the orig -> clone mapping recorded so far """
+        return JournaledEidMap(self._sql('SELECT orig, copy FROM container_clone_mapping '
+                                         'WHERE clone=%(clone)s').fetchall())
+
+    def done(self, step):
+        self._sql('INSERT INTO container_clone_steps (clone, step) '
+                  'VALUES (%(clone)s, %(step)s)', {'step': step})
+        self.steps.add(step)
+
+    def record(self, orig_to_clone, relations):
+        """ record the mapping entries and links collected since the last
+        call (the links are removed from the `relations` buffer) """
+        self._execmany('INSERT INTO container_clone_mapping (clone, orig, copy) '
+                       'VALUES (%(clone)s, %(orig)s, %(copy)s)',
+                       [{'clone': self.clone, 'orig': orig, 'copy': copy}
+                        for orig, copy in orig_to_clone.flushed()])
+        for rtype in relations.rtypes():
+            self._execmany('INSERT INTO container_clone_links (clone, rtype, eid_from, eid_to) '
+                           'VALUES (%(clone)s, %(rtype)s, %(from)s, %(to)s)',
+                           [{'clone': self.clone, 'rtype': rtype, 'from': subj, 'to': obj}
+                            for subj, obj in relations.pairs(rtype)])
+        relations.clear()
+
+    def links(self):
+        """ a RelationBuffer of all the recorded links """
+        relations = RelationBuffer()
+        for rtype, subj, obj in self._sql('SELECT DISTINCT rtype, eid_from, eid_to '
+                                          'FROM container_clone_links WHERE clone=%(clone)s'
+                                          ).fetchall():
+            relations.add(rtype, subj, obj)
+        return relations
+
+    def clear(self):
+        for table in ('container_clone_steps', 'container_clone_mapping',
+                      'container_clone_links'):
+            self._sql('DELETE FROM %s WHERE clone=%%(clone)s' % table)
+        self.steps = set()
@@ -0,0 +1,148 @@
+# copyright 2015 LOGILAB S.A. (Paris, FRANCE), all rights reserved.
+# contact http://www.logilab.fr -- mailto:contact@logilab.fr
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""cubicweb-container clone metrics and estimates"""
+from array import array
+from collections import defaultdict
+from contextlib import contextmanager
+from time import time
+
+from cubes.container.utils import EID_TYPECODE
+
+
+class CloneMetrics(object):
+    """ what a clone did and where it spent its time
+
+    * `fetched`, `inserted`: etype -> number of rows fetched / entities
+      inserted,
+    * `linked`: rtype -> number of links inserted,
+    * `inlined`: rtype -> number of inlined relations set afterwards
+      (deferred updates),
+    * `timings`: phase -> seconds spent, phases being 'fetch', 'insert',
+      'relink' (fetching the relations), 'link' (inserting them),
+      'deferred_hooks' and 'fti' (full text indexing, if any),
+    * `peak_mapping`: highest number of entries of the orig -> clone
+      mapping.
+
+    The `callback` is called with the metrics and a step name at the end
+    of each step of the clone (see ContainerClone.clone_progress).
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.start = time()
+        self.fetched = defaultdict(int)
+        self.inserted = defaultdict(int)
+        self.linked = defaultdict(int)
+        self.inlined = defaultdict(int)
+        self.timings = defaultdict(float)
+        self.peak_mapping = 0
+
+    @contextmanager
+    def timed(self, phase):
+        start = time()
+        try:
+            yield
+        finally:
+            self.timings[phase] += time() - start
+
+    def mapping_size(self, size):
+        if size > self.peak_mapping:
+            self.peak_mapping = size
+
+    def progress(self, step):
+        """ report the end of a clone `step` to the callback """
+        if self.callback is not None:
+            self.callback(self, step)
+
+    @property
+    def elapsed(self):
+        return time() - self.start
+
+    def as_dict(self):
+        """ a json serializable version of the metrics """
+        return {'fetched': dict(self.fetched),
+                'inserted': dict(self.inserted),
+                'linked': dict(self.linked),
+                'inlined': dict(self.inlined),
+                'timings': dict(self.timings),
+                'peak_mapping': self.peak_mapping,
+                'elapsed': self.elapsed}
+
+
+class CloneEstimate(object):
+    """ the expected size and cost of a clone (see ContainerClone.explain)
+
+    * `containers`: container etype -> number of containers to clone
+      into (the top one and the subcontainers),
+    * `entities`: etype -> number of entities,
+    * `links`: rtype -> number of (non inlined) links,
+    * `inlined`: (etype, rtype) -> number of valued inlined relations,
+    * `fast_inlined`, `deferred_inlined`: the (etype, rtype) inlined
+      relations set when the entities are inserted and those set
+      afterwards by bulk updates,
+    * `engine`: the clone engine the estimate is computed for ('python'
+      or 'sql'),
+    * `queries`: approximate number of queries the clone will issue,
+    * `mapping_memory`, `buffers_memory`: expected size in bytes of the
+      orig -> clone mapping and of the collected relations (none with the
+      sql engine, which keeps them in the database).
+
+    The fast and deferred inlined relations are those of the python engine.
+    """
+
+    def __init__(self):
+        self.containers = defaultdict(int)
+        self.entities = defaultdict(int)
+        self.links = defaultdict(int)
+        self.inlined = defaultdict(int)
+        self.fast_inlined = set()
+        self.deferred_inlined = set()
+        self.engine = 'python'
+        self.queries = 0
+
+    @property
+    def mapping_memory(self):
+        if self.engine == 'sql':
+            return 0
+        # an EidMap starts with 1024 slots and keeps its load under 2/3
+        count = sum(self.entities.itervalues()) + 1
+        size = 1024
+        while count * 3 > size * 2:
+            size <<= 1
+        return size * 2 * array(EID_TYPECODE).itemsize
+
+    @property
+    def buffers_memory(self):
+        if self.engine == 'sql':
+            return 0
+        count = (sum(self.links.itervalues()) +
+                 sum(self.inlined[key] for key in self.deferred_inlined))
+        return count * 2 * array(EID_TYPECODE).itemsize
+
+    def as_dict(self):
+        """ a json serializable version of the estimate """
+        return {'engine': self.engine,
+                'containers': dict(self.containers),
+                'entities': dict(self.entities),
+                'links': dict(self.links),
+                'inlined': dict(('%s.%s' % key, count)
+                                for key, count in self.inlined.iteritems()),
+                'fast_inlined': sorted('%s.%s' % key for key in self.fast_inlined),
+                'deferred_inlined': sorted('%s.%s' % key for key in self.deferred_inlined),
+                'queries': self.queries,
+                'mapping_memory': self.mapping_memory,
+                'buffers_memory': self.buffers_memory}
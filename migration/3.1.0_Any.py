@@ -0,0 +1,7 @@
+add_entity_type('CloneJob')
+
+from cubes.container.journal import JOURNAL_SQL
+
+for statement in JOURNAL_SQL:
+    sql(statement)
+commit()
@@ -20,6 +20,9 @@ the cube is added to an existing instance.
 You could setup site properties or a workflow here for example.
 """
 
-# Example of site property change
-#set_property('ui.site-title', "<sitename>")
+from cubes.container.journal import JOURNAL_SQL
+
+# the chunked clones journal
+for statement in JOURNAL_SQL:
+    sql(statement)
 
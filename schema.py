@@ -16,7 +16,7 @@
 
 """cubicweb-container schema"""
 
-from yams.buildobjs import RelationType
+from yams.buildobjs import EntityType, RelationType, String, Int, Datetime
 
 class container_etype(RelationType):
     object = 'CWEtype'
@@ -28,3 +28,25 @@ class container_parent(RelationType):
     cardinality='?*'
     inlined = True
 
+
+
+class CloneJob(EntityType):
+    """a container clone queued to be run in the background"""
+    __permissions__ = {'read': ('managers', 'users'),
+                       'add': ('managers', 'users'),
+                       'update': ('managers',),
+                       'delete': ('managers',)}
+    clone_eid = Int(required=True, indexed=True,
+                    description=u'eid of the container to clone into')
+    status = String(required=True, default=u'queued', indexed=True,
+                    vocabulary=(u'queued', u'running', u'done', u'failed'),
+                    internationalizable=True)
+    attempts = Int(required=True, default=0)
+    error = String(description=u'traceback of the last failed attempt')
+    metrics = String(description=u'json encoded metrics of the clone')
+    owner = String(maxsize=128,
+                   description=u'identifier of the instance running the job')
+    heartbeat = Datetime(description=u'last time (UTC) the owner reported '
+                         'the job as running')
+    operation = String(maxsize=256,
+                       description=u'dotted name of the operation class running the clone')
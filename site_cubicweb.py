@@ -19,3 +19,29 @@ def load(*args, **kwargs):
     SchemaLoader.schemacls.fs = False
     schema.fs = True
     return schema
+
+
+options = (
+    ('container-clone-workers',
+     {'type': 'int', 'default': 2,
+      'help': 'maximum number of background container clones run at once',
+      'group': 'container', 'level': 2,
+      }),
+    ('container-clone-max-attempts',
+     {'type': 'int', 'default': 3,
+      'help': 'number of times a failing background container clone is run',
+      'group': 'container', 'level': 2,
+      }),
+    ('container-clone-interval',
+     {'type': 'time', 'default': '10s',
+      'help': 'delay between two lookups of queued container clones',
+      'group': 'container', 'level': 2,
+      }),
+    ('container-clone-heartbeat-timeout',
+     {'type': 'time', 'default': '10min',
+      'help': 'delay after which a running container clone whose instance '
+      'stopped reporting it (e.g. after a crash) is queued again; it must '
+      'be well above container-clone-interval',
+      'group': 'container', 'level': 2,
+      }),
+)
@@ -0,0 +1,134 @@
+# copyright 2015 LOGILAB S.A. (Paris, FRANCE), all rights reserved.
+# contact http://www.logilab.fr -- mailto:contact@logilab.fr
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""cubicweb-container snapshots of the read phase of clones"""
+import cPickle as pickle
+from array import array
+from collections import OrderedDict
+from threading import Lock
+
+from cubes.container.utils import EID_TYPECODE
+
+
+# (clone adapter class, original container eid) -> ContainerSnapshot, the
+# least recently used first
+_SNAPSHOTS = OrderedDict()
+_LOCK = Lock()
+# bound (in bytes) of the rows held by all the snapshots: the least
+# recently used snapshots are dropped to make room for new rows
+MAX_SIZE = 256 * 1024 * 1024
+# estimated size of a value which is neither packed nor pickled
+VALUE_SIZE = 64
+
+
+def pack_rows(rows):
+    """ return a compact version of `rows` and its size in bytes
+
+    Rows of integers (eids) are kept as one array per column, the others
+    are pickled (or kept as is if they cannot be).
+    """
+    if rows and all(type(value) in (int, long) for row in rows for value in row):
+        columns = tuple(array(EID_TYPECODE, column) for column in zip(*rows))
+        return columns, sum(len(column) for column in columns) * columns[0].itemsize
+    try:
+        packed = pickle.dumps(rows, pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError):
+        return list(rows), VALUE_SIZE * sum(len(row) for row in rows)
+    return packed, len(packed)
+
+
+def unpack_rows(packed):
+    if isinstance(packed, tuple):
+        return zip(*packed)
+    if isinstance(packed, str):
+        return pickle.loads(packed)
+    return packed
+
+
+class ContainerSnapshot(object):
+    """ the rows read by the clones of a container
+
+    `rows` maps a read (as a tuple key chosen by the cloner) to its rows,
+    packed by `pack_rows`, and `eids` holds the eids of the container and
+    of the entities it contains: a change to one of them, or to one of
+    their relations (see the InvalidateCloneSnapshots hook), drops the
+    snapshot.
+    """
+
+    def __init__(self, orig_container_eid):
+        self.rows = {}
+        self.eids = set([orig_container_eid])
+        self.size = 0
+
+    def read(self, key, compute, inner=False):
+        """ the rows of `key`, computed by `compute` if not yet known
+
+        If `inner` is True, the first column of the rows holds eids of
+        entities of the container. The rows are not kept if they do not
+        fit in MAX_SIZE.
+        """
+        try:
+            return unpack_rows(self.rows[key])
+        except KeyError:
+            rows = compute()
+            if inner:
+                self.eids.update(row[0] for row in rows)
+            packed, size = pack_rows(rows)
+            if _make_room(self, size):
+                self.rows[key] = packed
+                self.size += size
+            return rows
+
+
+def _make_room(snapshot, size):
+    """ drop the least recently used snapshots (but `snapshot`) until
+    `size` more bytes fit in MAX_SIZE; tell whether they do """
+    with _LOCK:
+        total = sum(other.size for other in _SNAPSHOTS.itervalues())
+        for key, other in _SNAPSHOTS.items():
+            if total + size <= MAX_SIZE:
+                break
+            if other is not snapshot:
+                del _SNAPSHOTS[key]
+                total -= other.size
+        return total + size <= MAX_SIZE
+
+
+def get_snapshot(cloner_class, orig_container_eid):
+    """ the (possibly new) snapshot of a container clones """
+    key = (cloner_class, orig_container_eid)
+    with _LOCK:
+        snapshot = _SNAPSHOTS.pop(key, None)
+        if snapshot is None:
+            snapshot = ContainerSnapshot(orig_container_eid)
+        # most recently used
+        _SNAPSHOTS[key] = snapshot
+        return snapshot
+
+
+def has_snapshots():
+    return bool(_SNAPSHOTS)
+
+
+def invalidate_snapshots(eids=None):
+    """ drop the snapshots involving any of `eids` (all of them if None) """
+    with _LOCK:
+        if eids is None:
+            _SNAPSHOTS.clear()
+            return
+        for key, snapshot in _SNAPSHOTS.items():
+            if not snapshot.eids.isdisjoint(eids):
+                del _SNAPSHOTS[key]
@@ -0,0 +1,340 @@
+# copyright 2015 LOGILAB S.A. (Paris, FRANCE), all rights reserved.
+# contact http://www.logilab.fr -- mailto:contact@logilab.fr
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""cubicweb-container server side (sql) clone engine"""
+import sqlite3
+from collections import defaultdict, deque
+from datetime import datetime
+
+from cubicweb.server.sqlutils import SQL_PREFIX
+
+from cubes.container.utils import reserve_eids
+
+
+def has_row_number(cnx):
+    """ tell whether the database of the repository supports ROW_NUMBER(),
+    which SQLite only does since 3.25 """
+    if cnx.repo.system_source.dbdriver != 'sqlite':
+        return True
+    return sqlite3.sqlite_version_info >= (3, 25, 0)
+
+
+class SQLCloneEngine(object):
+    """ clone a container with `INSERT ... SELECT` statements only
+
+    The engine is driven by a ContainerClone adapter (it uses its ClonePlan
+    and those of the subcontainers) and works in three steps:
+
+    * the original eids of all entities to clone are collected, container
+      level by container level, into a temporary orig -> clone mapping
+      table; they are numbered with ROW_NUMBER() (or, on SQLite older
+      than 3.25, which lacks window functions, through a temporary table
+      with an INTEGER PRIMARY KEY) and the clone eids are computed from
+      these ranks once a single block of eids has been reserved for the
+      whole clone,
+
+    * the entities, etype tables and metadata relations rows are copied,
+      inlined columns being translated through the mapping table,
+
+    * the rows of the relation tables are copied, their ends being
+      translated through the mapping table.
+
+    Given `others` containers (of the same etype as the cloner's one), the
+    original is cloned into each of them too (a fan-out): the original
+    eids are collected once, the mapping table holds one copy of them per
+    target container and every statement writes all the copies at once.
+
+    No entity is ever loaded in Python and no hook is called: this is only
+    suitable when the cloner does not override the preprocessing hooks
+    nor the container scope (see ContainerClone._sql_clonable). The
+    clones are full text indexed only if asked by the cloner (see
+    ContainerClone.clone_fulltext_index).
+    """
+    maptable = 'container_clone_map'
+    # copy number -> top clone eid
+    copiestable = 'container_clone_copies'
+    # rank -> orig, when ROW_NUMBER() is not available
+    rankstable = 'container_clone_ranks'
+    # set by the engine rather than copied from the original
+    own_rtypes = frozenset(('creation_date', 'modification_date', 'cwuri'))
+
+    def __init__(self, cloner, others=()):
+        self.cloner = cloner
+        self.cnx = cloner._cw
+        self.clones = [cloner.entity] + list(others)
+        self.schema = self.cnx.vreg.schema
+        # [(level, plan)], a level being one batch of containers of the
+        # same etype (level 0 is the top container)
+        self.levels = []
+        self.row_number = has_row_number(self.cnx)
+
+    def sql(self, sql, args=None):
+        return self.cnx.system_sql(sql, args)
+
+    @property
+    def tables(self):
+        if self.row_number:
+            return (self.maptable, self.copiestable)
+        return (self.maptable, self.copiestable, self.rankstable)
+
+    def clone(self):
+        cloner = self.cloner
+        for table in self.tables:
+            self.sql('DROP TABLE IF EXISTS %s' % table)
+        self.sql('CREATE TEMPORARY TABLE %s (etype VARCHAR(64) NOT NULL, '
+                 'orig INTEGER NOT NULL, copy INTEGER NOT NULL, '
+                 'clone INTEGER NOT NULL, lvl INTEGER NOT NULL, '
+                 'PRIMARY KEY (orig, copy))' % self.maptable)
+        self.sql('CREATE TEMPORARY TABLE %s (copy INTEGER PRIMARY KEY, '
+                 'clone INTEGER NOT NULL)' % self.copiestable)
+        if not self.row_number:
+            self.sql('CREATE TEMPORARY TABLE %s (rnk INTEGER PRIMARY KEY, '
+                     'orig INTEGER NOT NULL)' % self.rankstable)
+        self.cnx.repo.system_source.doexecmany(
+            self.cnx, 'INSERT INTO %s (copy, clone) VALUES (%%(copy)s, %%(clone)s)'
+            % self.copiestable,
+            [{'copy': copy, 'clone': clone.eid} for copy, clone in enumerate(self.clones)])
+        metrics = cloner.metrics
+        try:
+            with metrics.timed('fetch'):
+                self.map_eids()
+            cloner.info('sql engine: copying entities')
+            with metrics.timed('insert'):
+                self.insert_entities()
+            cloner.info('sql engine: copying relations')
+            with metrics.timed('link'):
+                self.insert_relations()
+                self.relink_container()
+                self.special_relations()
+            cloner._fulltext_index([clone for clone, in self.sql(
+                'SELECT clone FROM %s WHERE lvl > 0' % self.maptable).fetchall()])
+        finally:
+            for table in self.tables:
+                self.sql('DROP TABLE %s' % table)
+        for clone in self.clones:
+            clone.cw_clear_all_caches()
+        metrics.progress('done')
+
+    # eids mapping
+
+    def map_eids(self):
+        """ fill the mapping table with the eids of all entities to clone
+
+        The original entities are collected as copy 0, the other copies
+        are derived from it once the number of entities is known.
+        """
+        cloner = self.cloner
+        top = cloner.entity
+        self.sql('INSERT INTO %s (etype, orig, copy, clone, lvl) '
+                 'SELECT %%(etype)s, %%(orig)s, copy, clone, 0 FROM %s'
+                 % (self.maptable, self.copiestable),
+                 {'etype': top.cw_etype, 'orig': cloner.orig_container_eid})
+        lvl = 0
+        # rank of the last mapped entity, the clone eids are computed
+        # from the ranks at the end
+        rank = 0
+        queue = deque([(top.cw_etype, 0, cloner)])
+        while queue:
+            cetype, plvl, ccloner = queue.popleft()
+            lvl += 1
+            plan = ccloner.plan
+            self.levels.append((lvl, plan))
+            where = ('FROM %(p)s%%(etype)s AS x '
+                     'WHERE x.%(p)s%(crtype)s IN (SELECT orig FROM %(map)s '
+                     '                          WHERE lvl=%(plvl)s AND copy=0 '
+                     '                          AND etype=\'%(cetype)s\') '
+                     'AND NOT x.%(p)seid IN (SELECT orig FROM %(map)s)'
+                     % {'p': SQL_PREFIX, 'crtype': plan.crtype, 'map': self.maptable,
+                        'plvl': plvl, 'cetype': cetype})
+            for etype in plan.etypes:
+                count = self._map_etype(etype, lvl, rank, where % {'etype': etype})
+                rank += count
+                cloner.metrics.fetched[etype] += count
+            for subcetype in ccloner.config.subcontainers:
+                row = self.sql('SELECT orig FROM %s WHERE lvl=%%(lvl)s AND etype=%%(etype)s '
+                               'LIMIT 1' % self.maptable,
+                               {'lvl': lvl, 'etype': subcetype}).fetchone()
+                if row is None:
+                    continue
+                subcloner = self.cnx.entity_from_eid(row[0]).cw_adapt_to('Container.clone')
+                queue.append((subcetype, lvl, subcloner))
+        ncopies = len(self.clones)
+        cloner.metrics.mapping_size((rank + 1) * ncopies)
+        if not rank:
+            return
+        if ncopies > 1:
+            # copy n of an entity of rank r gets the rank n * rank + r
+            self.sql('INSERT INTO %(map)s (etype, orig, copy, clone, lvl) '
+                     'SELECT m.etype, m.orig, c.copy, m.clone + c.copy * %%(rank)s, m.lvl '
+                     'FROM %(map)s AS m, %(copies)s AS c '
+                     'WHERE m.lvl > 0 AND m.copy=0 AND c.copy > 0'
+                     % {'map': self.maptable, 'copies': self.copiestable},
+                     {'rank': rank})
+        # one eid reservation for the whole clone
+        self.sql('UPDATE %s SET clone=clone + %%(first)s - 1 WHERE lvl > 0' % self.maptable,
+                 {'first': reserve_eids(self.cnx, rank * ncopies)})
+
+    def _map_etype(self, etype, lvl, rank, where):
+        """ map the `etype` entities selected by the `where` clause (on
+        `x`), numbered from `rank` + 1 in eid order; return their number """
+        args = {'etype': etype, 'lvl': lvl, 'rank': rank}
+        if self.row_number:
+            return self.sql('INSERT INTO %s (etype, orig, copy, clone, lvl) '
+                            'SELECT %%(etype)s, x.%seid, 0, '
+                            '%%(rank)s + ROW_NUMBER() OVER (ORDER BY x.%seid), %%(lvl)s '
+                            % (self.maptable, SQL_PREFIX, SQL_PREFIX) + where,
+                            args).rowcount
+        # the rows of an INTEGER PRIMARY KEY of an empty table are numbered
+        # from 1 in insertion order
+        self.sql('DELETE FROM %s' % self.rankstable)
+        self.sql('INSERT INTO %s (orig) SELECT x.%seid ' % (self.rankstable, SQL_PREFIX)
+                 + where + ' ORDER BY x.%seid' % SQL_PREFIX)
+        return self.sql('INSERT INTO %s (etype, orig, copy, clone, lvl) '
+                        'SELECT %%(etype)s, orig, 0, %%(rank)s + rnk, %%(lvl)s FROM %s'
+                        % (self.maptable, self.rankstable), args).rowcount
+
+    # entities
+
+    def _translated(self, column):
+        """ sql expression translating `column` through the mapping table,
+        into the copy of the mapping row `m` """
+        return ('COALESCE((SELECT t.clone FROM %s AS t WHERE t.orig=%s AND t.copy=m.copy), %s)'
+                % (self.maptable, column, column))
+
+    def insert_entities(self):
+        cnx = self.cnx
+        special = self.cloner._specially_handled_rtypes
+        self.sql("INSERT INTO entities (eid, type, asource, extid) "
+                 "SELECT clone, etype, 'system', NULL FROM %s WHERE lvl > 0" % self.maptable)
+        for lvl, plan in self.levels:
+            for etype in plan.etypes:
+                columns = ['%seid' % SQL_PREFIX]
+                selects = ['m.clone']
+                for rtype in plan.fetched_rtypes[etype]:
+                    if rtype in self.own_rtypes or rtype in special:
+                        continue
+                    column = 'x.%s%s' % (SQL_PREFIX, rtype)
+                    columns.append(SQL_PREFIX + rtype)
+                    if (rtype in plan.inlined_rtypes[etype] and
+                        rtype not in plan.crossing_border[etype]):
+                        selects.append(self._translated(column))
+                    else:
+                        selects.append(column)
+                columns += ['%scwuri' % SQL_PREFIX, '%screation_date' % SQL_PREFIX,
+                            '%smodification_date' % SQL_PREFIX]
+                # the cwuri the metadata hook would have given
+                selects += ['%(baseurl)s || CAST(m.clone AS TEXT)', '%(now)s', '%(now)s']
+                cursor = self.sql(
+                    'INSERT INTO %(p)s%(etype)s (%(columns)s) '
+                    'SELECT %(selects)s FROM %(p)s%(etype)s AS x, %(map)s AS m '
+                    'WHERE x.%(p)seid=m.orig AND m.lvl=%%(lvl)s AND m.etype=%%(etype)s'
+                    % {'p': SQL_PREFIX, 'etype': etype, 'map': self.maptable,
+                       'columns': ', '.join(columns), 'selects': ', '.join(selects)},
+                    {'lvl': lvl, 'etype': etype, 'now': datetime.utcnow(),
+                     'baseurl': cnx.base_url()})
+                self.cloner.metrics.inserted[etype] += cursor.rowcount
+        # metadata relations
+        etypes = set(etype for _lvl, plan in self.levels for etype in plan.etypes)
+        for etype in etypes:
+            eschema = self.schema[etype]
+            args = {'etype': etype}
+            self.sql('INSERT INTO is_relation (eid_from, eid_to) '
+                     'SELECT clone, %s FROM %s WHERE lvl > 0 AND etype=%%(etype)s'
+                     % (eschema.eid, self.maptable), args)
+            for parent in [eschema] + eschema.ancestors():
+                self.sql('INSERT INTO is_instance_of_relation (eid_from, eid_to) '
+                         'SELECT clone, %s FROM %s WHERE lvl > 0 AND etype=%%(etype)s'
+                         % (parent.eid, self.maptable), args)
+        for rtype, target in (('owned_by', cnx.user.eid),
+                              ('created_by', cnx.user.eid),
+                              ('cw_source', cnx.repo.system_source.eid)):
+            self.sql('INSERT INTO %s_relation (eid_from, eid_to) '
+                     'SELECT clone, %%(target)s FROM %s WHERE lvl > 0'
+                     % (rtype, self.maptable), {'target': target})
+
+    # relations
+
+    def insert_relations(self):
+        special = self.cloner._specially_handled_rtypes
+        rtype_etypes = defaultdict(set)
+        for _lvl, plan in self.levels:
+            for etype in plan.etypes:
+                for rtype, _rql in plan.relink_rql[etype]:
+                    if rtype not in special and rtype != 'cw_source':
+                        rtype_etypes[rtype].add(etype)
+        for rtype, etypes in rtype_etypes.iteritems():
+            sql = ('INSERT INTO %(rtype)s_relation (eid_from, eid_to) '
+                   'SELECT DISTINCT %(from)s, %(to)s FROM %(rtype)s_relation AS rel '
+                   'JOIN %(map)s AS ms ON ms.orig=rel.eid_from '
+                   'LEFT OUTER JOIN %(map)s AS mo ON mo.orig=rel.eid_to AND mo.copy=ms.copy '
+                   'WHERE ms.lvl > 0 AND ms.etype IN (%(etypes)s)')
+            args = {'rtype': rtype, 'map': self.maptable,
+                    'etypes': ', '.join("'%s'" % etype for etype in sorted(etypes))}
+            cursor = self.sql(sql % dict(args, **{'from': 'ms.clone',
+                                                  'to': 'COALESCE(mo.clone, rel.eid_to)'}))
+            self.cloner.metrics.linked[rtype] += cursor.rowcount
+            if self.schema[rtype].symmetric:
+                # the reverse rows of links to outer entities
+                self.sql(sql % dict(args, **{'from': 'rel.eid_to', 'to': 'ms.clone'})
+                         + ' AND mo.orig IS NULL')
+
+    def relink_container(self):
+        """ copy the subject relations of the original container the
+        clones have not already got """
+        cloner = self.cloner
+        special = cloner._specially_handled_rtypes
+        args = {'orig': cloner.orig_container_eid}
+        for rtype, _rql, _existsrql in cloner.plan.container_relink_rql:
+            if rtype in special or rtype == 'cw_source':
+                continue
+            self.sql('INSERT INTO %(rtype)s_relation (eid_from, eid_to) '
+                     'SELECT c.clone, COALESCE(mo.clone, rel.eid_to) '
+                     'FROM %(copies)s AS c '
+                     'JOIN %(rtype)s_relation AS rel ON rel.eid_from=%%(orig)s '
+                     'LEFT OUTER JOIN %(map)s AS mo ON mo.orig=rel.eid_to AND mo.copy=c.copy '
+                     'WHERE NOT EXISTS '
+                     '(SELECT 1 FROM %(rtype)s_relation AS e WHERE e.eid_from=c.clone)'
+                     % {'rtype': rtype, 'map': self.maptable,
+                        'copies': self.copiestable}, args)
+
+    def special_relations(self):
+        """ hand the specially handled relations to the cloner, as
+        (rtype, clone eid, original target eid) triples """
+        cloner = self.cloner
+        special = cloner._specially_handled_rtypes
+        if not special:
+            return
+        deferred = []
+        for lvl, plan in self.levels:
+            for etype in plan.etypes:
+                for rtype in plan.inlined_rtypes[etype] & frozenset(special):
+                    deferred += self.sql(
+                        'SELECT %%(rtype)s, m.clone, x.%(p)s%(rtype)s '
+                        'FROM %(p)s%(etype)s AS x, %(map)s AS m '
+                        'WHERE x.%(p)seid=m.orig AND m.lvl=%%(lvl)s AND m.etype=%%(etype)s'
+                        % {'p': SQL_PREFIX, 'rtype': rtype, 'etype': etype,
+                           'map': self.maptable},
+                        {'rtype': rtype, 'lvl': lvl, 'etype': etype}).fetchall()
+        for rtype in special:
+            if self.schema[rtype].inlined:
+                continue
+            deferred += self.sql('SELECT %%(rtype)s, m.clone, rel.eid_to '
+                                 'FROM %(rtype)s_relation AS rel, %(map)s AS m '
+                                 'WHERE rel.eid_from=m.orig'
+                                 % {'rtype': rtype, 'map': self.maptable},
+                                 {'rtype': rtype}).fetchall()
+        if deferred:
+            cloner.handle_special_relations(tuple(row) for row in deferred)
@@ -0,0 +1,84 @@
+"""Compare the memory and speed of EidMap and a plain dict as the
+orig -> clone mapping of a data-tracker Project clone.
+
+Not collected by the test suite, run it explicitly::
+
+  pytest -s test/benchmark_eidmap.py
+"""
+import sys
+import time
+
+from logilab.common.testlib import unittest_main
+
+from cubicweb.devtools import testlib
+
+from cubes.container.utils import EidMap
+from cubes.container.testutils import new_version, new_ticket
+
+
+NB_TICKETS = 5000
+
+
+def dict_size(mapping):
+    # the dict itself plus its python int keys and values
+    return sys.getsizeof(mapping) + sum(sys.getsizeof(key) + sys.getsizeof(value)
+                                        for key, value in mapping.iteritems())
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+class EidMapBenchmarkTC(testlib.CubicWebTC):
+    appid = 'data-tracker'
+
+    def setup_database(self):
+        with self.admin_access.repo_cnx() as cnx:
+            proj = cnx.create_entity('Project', name=u'Babar')
+            ver = new_version(cnx, proj.eid)
+            for num in xrange(NB_TICKETS):
+                new_ticket(cnx, proj.eid, ver, name=u'ticket %s' % num)
+            cnx.commit()
+
+    def _orig_clone_pairs(self, cnx):
+        babar = cnx.find('Project', name=u'Babar').one()
+        clone = cnx.create_entity('Project', name=u'Babar clone')
+        cnx.commit()
+        cloner = clone.cw_adapt_to('Container.clone')
+        with cnx.deny_all_hooks_but(*cloner.config.compulsory_hooks_categories):
+            cloner.clone(original=babar.eid)
+            cnx.commit()
+        origs = [eid for eid, in cnx.execute('Any X ORDERBY X WHERE X project P, P eid %(p)s',
+                                             {'p': babar.eid})]
+        clones = [eid for eid, in cnx.execute('Any X ORDERBY X WHERE X project P, P eid %(p)s',
+                                              {'p': clone.eid})]
+        self.assertEqual(len(origs), len(clones))
+        return zip(origs, clones)
+
+    def test_eidmap_vs_dict(self):
+        with self.admin_access.repo_cnx() as cnx:
+            pairs = self._orig_clone_pairs(cnx)
+        origs = [orig for orig, _clone in pairs]
+        results = []
+        for factory in (dict, EidMap):
+            build_time, mapping = timed(factory, pairs)
+            lookup_time, _ = timed(lambda: [mapping[eid] for eid in origs])
+            if factory is dict:
+                size = dict_size(mapping)
+                translate_time, _ = timed(lambda: [mapping.get(eid, eid) for eid in origs])
+            else:
+                size = mapping.memory_size()
+                translate_time, _ = timed(mapping.translate, origs)
+            results.append((factory.__name__, size, build_time, lookup_time, translate_time))
+        print
+        print '%d entries' % len(pairs)
+        for name, size, build_time, lookup_time, translate_time in results:
+            print ('%-8s %6.1f bytes/entry, build %.3fs, lookup %.3fs, translate %.3fs'
+                   % (name, float(size) / len(pairs), build_time, lookup_time, translate_time))
+        self.assertLess(results[1][1], results[0][1])
+
+
+if __name__ == '__main__':
+    unittest_main()
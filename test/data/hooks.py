@@ -2,8 +2,18 @@ from cubicweb.server.hook import match_rtype
 from cubes.container import hooks
 
 
+class CloneDiamondOp(hooks.CloneContainerOp):
+    # eids of the finalized clones
+    finalized = []
+
+    @classmethod
+    def finalize_cloned_container(cls, cnx, clone):
+        cls.finalized.append(clone.eid)
+
+
 class CloneDiamond(hooks.CloneContainer):
     __select__ = hooks.CloneContainer.__select__ & match_rtype('is_clone_of')
+    operation = CloneDiamondOp
 
 
 def registration_callback(vreg):
@@ -1,7 +1,15 @@
+from datetime import datetime, timedelta
+
 from logilab.common.testlib import unittest_main
 
 from cubicweb import ValidationError
 from cubicweb.devtools import testlib
+from cubicweb.server.hook import Operation
+
+from cubes.container.config import Container
+from cubes.container.hooks import (CloneContainerOp, eid_etype, cwetype_eid,
+                                   _CWETYPE_EIDS)
+from cubes.container.jobs import CloneJobRunner, operation_class
 
 
 class ContainerLessTC(testlib.CubicWebTC):
@@ -60,6 +68,64 @@ class ContainerEntitiesTC(testlib.CubicWebTC):
                               u'Right -> Diamond (TopClone)'],
                              sorted([x.dc_title() for x in newd.reverse_diamond]))
 
+    def test_is_clone_of_relation_in_background(self):
+        config = Container.by_etype('Diamond')
+        config.clone_in_background = True
+        try:
+            with self.admin_access.repo_cnx() as cnx:
+                newd = cnx.create_entity('Diamond', name=u'TopClone')
+                newd.cw_set(is_clone_of=self.d)
+                cnx.commit()
+                job = cnx.find('CloneJob', clone_eid=newd.eid).one()
+                self.assertEqual(u'queued', job.status)
+                # the job is run by the operation of the clone hook
+                operation = operation_class(CloneContainerOp, job.operation)
+                self.assertEqual('CloneDiamondOp', operation.__name__)
+                self.assertNotIn(newd.eid, operation.finalized)
+                newd = cnx.entity_from_eid(newd.eid)
+                self.assertEqual([u'Diamond (TopClone)'],
+                                 [x.dc_title() for x in newd.reverse_diamond])
+            runner = CloneJobRunner(self.repo, CloneContainerOp, workers=1)
+            with self.admin_access.repo_cnx() as cnx:
+                self.assertTrue(runner.claim(cnx, job.eid))
+                self.assertFalse(runner.claim(cnx, job.eid))
+                cnx.commit()
+            runner.run_job(job.eid)
+            with self.admin_access.repo_cnx() as cnx:
+                job = cnx.entity_from_eid(job.eid)
+                self.assertEqual((u'done', 1), (job.status, job.attempts))
+                newd = cnx.entity_from_eid(newd.eid)
+                self.assertEqual(5, len(newd.reverse_diamond))
+            self.assertIn(newd.eid, operation.finalized)
+        finally:
+            config.clone_in_background = False
+
+    def test_clone_job_heartbeat(self):
+        with self.admin_access.repo_cnx() as cnx:
+            newd = cnx.create_entity('Diamond', name=u'TopClone')
+            job = cnx.create_entity('CloneJob', clone_eid=newd.eid)
+            cnx.commit()
+        runner = CloneJobRunner(self.repo, CloneContainerOp, workers=1,
+                                heartbeat_timeout=60)
+        other = CloneJobRunner(self.repo, CloneContainerOp, workers=1,
+                               heartbeat_timeout=60)
+        with self.admin_access.repo_cnx() as cnx:
+            self.assertTrue(other.claim(cnx, job.eid))
+            cnx.commit()
+            # the job of a live instance is left alone
+            self.assertEqual(0, runner.requeue_stale(cnx))
+            job = cnx.entity_from_eid(job.eid)
+            self.assertEqual((u'running', other.owner), (job.status, job.owner))
+            # until its heartbeat expires
+            cnx.system_sql('UPDATE cw_CloneJob SET cw_heartbeat=%(old)s',
+                           {'old': datetime.utcnow() - timedelta(hours=1)})
+            self.assertEqual(1, runner.requeue_stale(cnx))
+            cnx.commit()
+            job = cnx.entity_from_eid(job.eid)
+            self.assertEqual((u'queued', None), (job.status, job.owner))
+            self.assertTrue(runner.claim(cnx, job.eid))
+            cnx.commit()
+
     def test_container_relation_hook(self):
         with self.admin_access.repo_cnx() as cnx:
             u = cnx.create_entity('NearTop', reverse_has_near_top=self.d)
@@ -73,6 +139,67 @@ class ContainerEntitiesTC(testlib.CubicWebTC):
             self.assertEqual(self.d.eid, u.cw_adapt_to('Container').parent.eid)
             self.assertEqual(self.d.eid, u.cw_adapt_to('Container').related_container.eid)
 
+    def test_eid_etype_cache(self):
+        with self.admin_access.repo_cnx() as cnx:
+            l = cnx.create_entity('Left', top_from_left=self.d)
+            etypes = cnx.transaction_data['container.eid_etype']
+            # filled by the structural relation hooks
+            self.assertEqual('Left', etypes[l.eid])
+            self.assertEqual('Diamond', etypes[self.d.eid])
+            cnx.commit()
+            self.assertEqual('Right', eid_etype(cnx, self.r.eid))
+            self.assertEqual({self.r.eid: 'Right'}, cnx.transaction_data['container.eid_etype'])
+
+    def test_container_relation_insertion_order(self):
+        with self.admin_access.repo_cnx() as cnx:
+            # the bottom is linked to its parent before the parent is
+            # linked to the container
+            l = cnx.create_entity('Left')
+            b = cnx.create_entity('Bottom', top_by_left=l)
+            l.cw_set(top_from_left=self.d)
+            cnx.commit()
+            for eid in (l.eid, b.eid):
+                entity = cnx.entity_from_eid(eid)
+                self.assertEqual(self.d.eid,
+                                 entity.cw_adapt_to('Container').related_container.eid)
+                self.assertEqual('Diamond', entity.container_etype[0].name)
+
+    def test_container_parent_operation(self):
+        with self.admin_access.repo_cnx() as cnx:
+            b = cnx.create_entity('Bottom', top_by_left=self.l)
+            # the first parent of a new entity is set before commit
+            self.assertEqual({b.eid: [('top_by_left', self.l.eid)]},
+                             cnx.transaction_data['container.pending_parents'])
+            i = cnx.create_entity('IAmAnAttributeCarryingRelation',
+                                  foo=42, to_left=self.l, to_right=self.r)
+            self.assertEqual(2, len(cnx.transaction_data['container.pending_parents'][i.eid]))
+            cnx.commit()
+            b = cnx.entity_from_eid(b.eid)
+            self.assertEqual(self.l.eid, b.container_parent[0].eid)
+            self.assertEqual(self.d.eid, b.cw_adapt_to('Container').related_container.eid)
+            i = cnx.entity_from_eid(i.eid)
+            self.assertIn(i.container_parent[0].eid, (self.l.eid, self.r.eid))
+
+    def test_container_parent_late_relation(self):
+        class LateRelationOp(Operation):
+            def precommit_event(self):
+                self.bottom = self.cnx.create_entity('Bottom', top_by_left=l)
+        with self.admin_access.repo_cnx() as cnx:
+            l = cnx.entity_from_eid(self.l.eid)
+            op = LateRelationOp(cnx)
+            # SetContainerParentOp runs before the late operation
+            b = cnx.create_entity('Bottom', top_by_left=l)
+            cnx.commit()
+            for eid in (b.eid, op.bottom.eid):
+                bottom = cnx.entity_from_eid(eid)
+                self.assertEqual(self.l.eid, bottom.container_parent[0].eid)
+
+    def test_cwetype_eid_cache(self):
+        with self.admin_access.repo_cnx() as cnx:
+            diamond = cnx.find('CWEType', name=u'Diamond').one()
+            self.assertEqual(diamond.eid, cwetype_eid(cnx, 'Diamond'))
+            self.assertEqual(diamond.eid, _CWETYPE_EIDS[self.repo]['Diamond'])
+
     def test_container_rtype_hook(self):
         with self.admin_access.repo_cnx() as cnx:
             self.assertEqual(5, len(cnx.execute('Any X,Y WHERE X diamond Y')))
@@ -1,14 +1,124 @@
 import time
+from array import array
+from unittest import TestCase
 
 from cubicweb import Binary
 
 from cubicweb.devtools import testlib
 
-from cubes.container import utils
+from cubes.container import snapshot, utils
+from cubes.container.utils import EidMap, RelationBuffer, reserve_eids, EID_TYPECODE
 from cubes.container.config import Container
+from cubes.container.hooks import (match_rdefs, AddContainerRelationOp,
+                                   InvalidateCloneSnapshotsOp)
+from cubes.container.sqlclone import SQLCloneEngine
 from cubes.container.testutils import (new_version, new_ticket,
                                        new_patch, new_card, rdefrepr)
 
+EIDSIZE = array(EID_TYPECODE).itemsize
+
+
+class EidMapTC(TestCase):
+
+    def test_mapping(self):
+        eidmap = EidMap({1: 2})
+        for eid in xrange(10, 10000, 7):
+            eidmap[eid] = eid + 1
+        eidmap[1] = 3
+        self.assertEqual(1 + len(xrange(10, 10000, 7)), len(eidmap))
+        self.assertEqual(3, eidmap[1])
+        self.assertEqual(18, eidmap[17])
+        self.assertIn(17, eidmap)
+        self.assertNotIn(18, eidmap)
+        self.assertNotIn(None, eidmap)
+        self.assertIsNone(eidmap.get(None))
+        self.assertEqual(42, eidmap.get(18, 42))
+        self.assertRaises(KeyError, eidmap.__getitem__, 18)
+        self.assertEqual([3, 18, 18], list(eidmap.translate([1, 17, 18], keep_missing=True)))
+        self.assertRaises(KeyError, eidmap.translate, [1, 18])
+        self.assertEqual(dict((eid, eid + 1) for eid in xrange(10, 10000, 7)),
+                         dict((k, v) for k, v in eidmap.iteritems() if k != 1))
+
+
+class RelationBufferTC(TestCase):
+
+    def test_buffer(self):
+        relations = RelationBuffer()
+        relations.extend('concerns', [(1, 2), (3, 2)])
+        other = RelationBuffer()
+        other.add('concerns', 1, 2)
+        other.add('requirement', 3, 4)
+        relations.update(other)
+        self.assertEqual(['concerns', 'requirement'], sorted(relations.rtypes()))
+        self.assertEqual(3, relations.count('concerns'))
+        self.assertEqual([(1, 2), (3, 2)], relations.pairs('concerns'))
+        subjects, objects = relations.translated('concerns', EidMap({1: 10, 3: 30}))
+        self.assertEqual([10, 30], list(subjects))
+        self.assertEqual([2, 2], list(objects))
+        subjects, objects = relations.translated('requirement', EidMap({3: 30, 4: 40}))
+        self.assertEqual(([30], [40]), (list(subjects), list(objects)))
+        self.assertRaises(KeyError, relations.translated, 'concerns', EidMap({1: 10}))
+
+    def test_dedup(self):
+        subjects = array(EID_TYPECODE, [5, 1, 2 ** 31 - 1, 1, 5] * 3)
+        objects = array(EID_TYPECODE, [6, 2, 2 ** 31 - 1, 2, 7] * 3)
+        # duplicates within and across the chunks
+        dsubjects, dobjects = RelationBuffer._dedup(subjects, objects, chunksize=4)
+        self.assertEqual([(1, 2), (5, 6), (5, 7), (2 ** 31 - 1, 2 ** 31 - 1)],
+                         zip(dsubjects, dobjects))
+
+
+class SnapshotTC(TestCase):
+
+    def tearDown(self):
+        snapshot.invalidate_snapshots()
+
+    def test_pack_rows(self):
+        packed, size = snapshot.pack_rows([[1, 2], [3, 4]])
+        self.assertEqual(4 * EIDSIZE, size)
+        self.assertEqual([(1, 2), (3, 4)], snapshot.unpack_rows(packed))
+        rows = [[1, u'babar', None]]
+        packed, size = snapshot.pack_rows(rows)
+        self.assertEqual(len(packed), size)
+        self.assertEqual(rows, snapshot.unpack_rows(packed))
+
+    def test_bounded(self):
+        max_size = snapshot.MAX_SIZE
+        snapshot.MAX_SIZE = 4 * EIDSIZE
+        try:
+            first = snapshot.get_snapshot(TestCase, 1)
+            first.read('a', lambda: [[1, 2], [3, 4]])
+            self.assertEqual(4 * EIDSIZE, first.size)
+            second = snapshot.get_snapshot(TestCase, 2)
+            self.assertEqual([[5, 6]], second.read('a', lambda: [[5, 6]]))
+            # the least recently used snapshot made room
+            self.assertEqual([second], snapshot._SNAPSHOTS.values())
+            # too big to be kept
+            rows = [[eid, eid] for eid in xrange(10)]
+            self.assertEqual(rows, second.read('b', lambda: rows))
+            self.assertNotIn('b', second.rows)
+        finally:
+            snapshot.MAX_SIZE = max_size
+
+
+class CloneOrderTC(TestCase):
+
+    def test_cycle_breaking_order(self):
+        edges = {('A', 'a_b'): set(['B']), ('B', 'b_c'): set(['C']),
+                 ('C', 'c_a'): set(['A']), ('C', 'c_b'): set(['B']),
+                 ('D', 'd_a'): set(['A'])}
+        weights = {('A', 'a_b'): (False, 10), ('B', 'b_c'): (False, 5),
+                   ('C', 'c_a'): (False, 1), ('C', 'c_b'): (True, 0),
+                   ('D', 'd_a'): (False, 0)}
+        rank = {'A': 0, 'B': 1, 'C': 2, 'D': 3}
+        self.assertEqual([['A', 'B', 'C'], ['D']],
+                         utils.strongly_connected_components(
+                             {'A': ['B'], 'B': ['C'], 'C': ['A', 'B'], 'D': ['A']}))
+        # c_a, the lightest, breaks the A-B-C cycle, but B-C remains and
+        # breaking it with b_c is enough
+        self.assertEqual((['B', 'A', 'C', 'D'], set([('B', 'b_c')])),
+                         utils.cycle_breaking_order(edges, weights, rank))
+
 
 class TwoContainersTC(testlib.CubicWebTC):
     appid = 'data-tracker'
@@ -58,6 +168,13 @@ class TwoContainersTC(testlib.CubicWebTC):
         self.assertEqual(['Folder', 'Card', 'XFile'],
                          folder.ordered_etypes)
 
+    def test_clone_order(self):
+        project = Container.by_etype('Project')
+        # versions first: the tickets done_in_version are set at once
+        self.assertEqual((['Project', 'Folder', 'Version', 'Ticket', 'Card', 'Patch'], set()),
+                         project.clone_order())
+        self.assertEqual(project.clone_order()[0], project.clone_ordered_etypes)
+
     def test_project_hooks(self):
         project = Container.by_etype('Project')
         self.assertEqual({'documents': set([('Folder', 'Project')]),
@@ -81,6 +198,15 @@ class TwoContainersTC(testlib.CubicWebTC):
                               ('requirement', 'Ticket', 'Card')]),
                          set([rdefrepr(rdef) for rdef in folder.border_rdefs]))
 
+    def test_match_rdefs(self):
+        folder = Container.by_etype('Folder')
+        selector = match_rdefs(*folder.rdefs)
+        self.assertEqual(frozenset(['element', 'parent']), selector.rtypes)
+        self.assertEqual(set([rdefrepr(rdef) for rdef in folder.rdefs]),
+                         selector.triples)
+        # other rtypes are rejected before the eids are looked at
+        self.assertEqual(0, selector(None, None, rtype='documents'))
+
 
 def parent_titles(parent):
     parents = []
@@ -165,6 +291,18 @@ class CloneTC(testlib.CubicWebTC):
             self.assertEqual([babar], foldr.project)
             self.assertEqual([foldr], foldr.folder_root)
 
+    def test_committed_containers(self):
+        with self.admin_access.repo_cnx() as cnx:
+            babar = cnx.find('Project', name=u'Babar').one()
+            card = cnx.execute('Card C WHERE F element C, F name "Babar documentation"').one()
+            with cnx.deny_all_hooks_but():
+                card.cw_set(project=babar)
+            # the container relation of the container etype is followed
+            op = AddContainerRelationOp(cnx)
+            self.assertEqual({card.eid: card.folder_root[0].eid},
+                             op._committed_containers([card.eid], {card.eid: 'Card'}))
+            cnx.rollback()
+
     def test_clone(self):
         with self.admin_access.repo_cnx() as cnx:
             self.assertEqual(6, cnx.execute('Any COUNT(X) WHERE X container_parent Y').rows[0][0])
@@ -317,3 +455,522 @@ class CloneTC(testlib.CubicWebTC):
             self.assertEqual([user], folder.created_by)
             self.assertTrue(project.creation_date > babar.creation_date)
             self.assertTrue(project.modification_date > babar.modification_date)
+
+    def _record_reads(self, cloner, reads):
+        """ append the (query, query arguments) read by `cloner` to `reads` """
+        read = cloner._read
+        def recording_read(query, queryargs=None, **kwargs):
+            reads.append((query, dict(queryargs or {})))
+            return read(query, queryargs, **kwargs)
+        cloner._read = recording_read
+
+    def _clone_babar(self, cnx, name, reads=None, **cloner_attrs):
+        babar = cnx.find('Project', name=u'Babar').one()
+        clone = cnx.create_entity('Project', name=name)
+        cnx.commit()
+        cloner = clone.cw_adapt_to('Container.clone')
+        for attr, value in cloner_attrs.iteritems():
+            setattr(cloner, attr, value)
+        if reads is not None:
+            self._record_reads(cloner, reads)
+        with cnx.deny_all_hooks_but(*cloner.config.compulsory_hooks_categories):
+            cloner.clone(original=babar.eid)
+            cnx.commit()
+        clone.cw_clear_all_caches()
+        return clone
+
+    def _check_babar_clone(self, cnx, clone):
+        self.assertEqual([('Card', u"Let's start a spec ..."),
+                          ('Folder', u'Babar documentation'),
+                          ('Patch', u'some code'),
+                          ('Project', clone.name),
+                          ('Project', u'Celeste'),
+                          ('Ticket', u'think about it'),
+                          ('Version', u'0.1.0')],
+                         sorted([(e.__regid__, e.dc_title())
+                                 for e in clone.reverse_project]))
+        cloned_ticket = cnx.execute('Ticket T WHERE T concerns P, P eid %(p)s',
+                                    {'p': clone.eid}).one()
+        self.assertEqual(clone.name,
+                         cloned_ticket.done_in_version[0].version_of[0].name)
+        cloned_folder = cnx.execute('Folder F WHERE F documents P, P eid %(p)s',
+                                    {'p': clone.eid}).one()
+        self.assertEqual(set([u'XFile', u'Card']),
+                         set(e.cw_etype for e in cloned_folder.element))
+
+    def test_clone_paged(self):
+        with self.admin_access.repo_cnx() as cnx:
+            reads = []
+            clone = self._clone_babar(cnx, u'Babar paged clone', reads=reads,
+                                      clone_page_size=1)
+            self._check_babar_clone(cnx, clone)
+            # the relink queries are paged too
+            plan = clone.cw_adapt_to('Container.clone').plan
+            paged_relink = set(paged for paged, _subject
+                               in plan._paged_relink_rql.itervalues())
+            self.assertTrue(paged_relink)
+            relink_pages = [queryargs['lasteid'] for query, queryargs in reads
+                            if query in paged_relink]
+            self.assertIn(0, relink_pages)
+            self.assertTrue([lasteid for lasteid in relink_pages if lasteid > 0])
+
+    def test_clone_fused_fetch(self):
+        with self.admin_access.repo_cnx() as cnx:
+            reads, fused_reads = [], []
+            self._clone_babar(cnx, u'Babar clone', reads=reads)
+            clone = self._clone_babar(cnx, u'Babar fused clone', reads=fused_reads,
+                                      clone_fused_fetch=True)
+            self._check_babar_clone(cnx, clone)
+            # one relations query per etype instead of one per relink rtype
+            plan = clone.cw_adapt_to('Container.clone').plan
+            saved = sum(max(len(plan.relink_rql[etype]) - 1, 0) for etype in plan.etypes)
+            self.assertGreater(saved, 0)
+            self.assertEqual(len(reads) - saved, len(fused_reads))
+
+    def test_clone_batched_subcontainers(self):
+        with self.admin_access.repo_cnx() as cnx:
+            celeste = cnx.find('Project', name=u'Celeste').one()
+            # a sub-subproject, to check recursive containers
+            cnx.create_entity('Project', name=u'Arthur', subproject_of=celeste)
+            cnx.commit()
+            clone = self._clone_babar(cnx, u'Babar batched clone',
+                                      clone_subcontainers_batch_size=10)
+            cloned_celeste = clone.reverse_subproject_of[0]
+            self.assertEqual([('Card', u'Write me'),
+                              ('Folder', u'Celeste bio'),
+                              ('Patch', u'bio part one'),
+                              ('Project', u'Arthur'),
+                              ('Ticket', u'write bio'),
+                              ('Version', u'0.1.0')],
+                             sorted([(e.__regid__, e.dc_title())
+                                     for e in cloned_celeste.reverse_project]))
+            cloned_arthur = cloned_celeste.reverse_subproject_of[0]
+            self.assertNotEqual(cnx.find('Project', name=u'Arthur').one().eid,
+                                cloned_arthur.eid)
+            cloned_folder = cnx.execute('Folder F WHERE F documents P, P eid %(p)s',
+                                        {'p': cloned_celeste.eid}).one()
+            self.assertEqual([cloned_folder], cloned_folder.folder_root)
+            self.assertEqual(set([u'XFile', u'Card']),
+                             set(e.cw_etype for e in cloned_folder.element))
+
+    def test_clone_batched_subcontainers_fallback(self):
+        steps = []
+        def clone_progress(metrics, step):
+            steps.append(step)
+        def preprocess_batch(cloner, etype, oldeids, columns):
+            pass
+        with self.admin_access.repo_cnx() as cnx:
+            celeste = cnx.find('Project', name=u'Celeste').one()
+            cnx.create_entity('Project', name=u'Arthur', subproject_of=celeste)
+            cnx.commit()
+            cloner_class = type(celeste.cw_adapt_to('Container.clone'))
+            # a preprocessing hook may depend on the adapted container
+            cloner_class.preprocess_batch = preprocess_batch
+            try:
+                clone = self._clone_babar(cnx, u'Babar batched clone',
+                                          clone_subcontainers_batch_size=10,
+                                          clone_progress=clone_progress)
+            finally:
+                del cloner_class.preprocess_batch
+            self._check_babar_clone(cnx, clone)
+            cloned_celeste = clone.reverse_subproject_of[0]
+            cloned_arthur = cloned_celeste.reverse_subproject_of[0]
+            # the subprojects are cloned one at a time
+            self.assertIn('etype:%s:Ticket' % cloned_celeste.eid, steps)
+            self.assertIn('etype:%s:Project' % cloned_arthur.eid, steps)
+            self.assertNotEqual(cnx.find('Project', name=u'Arthur').one().eid,
+                                cloned_arthur.eid)
+
+    def test_clone_chunked_batched_steps(self):
+        steps = []
+        def clone_progress(metrics, step):
+            steps.append(step)
+        with self.admin_access.repo_cnx() as cnx:
+            clone = self._clone_babar(cnx, u'Babar chunked batched clone',
+                                      clone_chunked=True, clone_subcontainers_batch_size=10,
+                                      clone_progress=clone_progress)
+            self._check_babar_clone(cnx, clone)
+            cloned_celeste = clone.reverse_subproject_of[0]
+            # the batch steps are keyed by the clones of its containers
+            self.assertIn('etype:%s-%s:Ticket' % (cloned_celeste.eid, cloned_celeste.eid),
+                          steps)
+
+    def test_clone_chunked(self):
+        with self.admin_access.repo_cnx() as cnx:
+            clone = self._clone_babar(cnx, u'Babar chunked clone', clone_chunked=True)
+            self._check_babar_clone(cnx, clone)
+            self.assertFalse(clone.cw_adapt_to('Container.clone').clone_incomplete)
+
+    def test_clone_chunked_resume(self):
+        with self.admin_access.repo_cnx() as cnx:
+            babar = cnx.find('Project', name=u'Babar').one()
+            clone = cnx.create_entity('Project', name=u'Babar resumed clone')
+            cnx.commit()
+            cloner = clone.cw_adapt_to('Container.clone')
+            cloner.clone_chunked = True
+            etype_clone = cloner._etype_clone
+            def crashing_etype_clone(etype, orig_to_clone):
+                if etype == 'Card':
+                    raise RuntimeError('crash')
+                return etype_clone(etype, orig_to_clone)
+            cloner._etype_clone = crashing_etype_clone
+            with cnx.deny_all_hooks_but(*cloner.config.compulsory_hooks_categories):
+                with self.assertRaises(RuntimeError):
+                    cloner.clone(original=babar.eid)
+                cnx.rollback()
+                clone = cnx.entity_from_eid(clone.eid)
+                cloner = clone.cw_adapt_to('Container.clone')
+                self.assertTrue(cloner.clone_incomplete)
+                # the tickets have been committed
+                self.assertEqual(1, len(clone.reverse_concerns))
+                cloner.clone_chunked = True
+                cloner.clone(original=babar.eid)
+                cnx.commit()
+            clone = cnx.entity_from_eid(clone.eid)
+            self._check_babar_clone(cnx, clone)
+            self.assertFalse(clone.cw_adapt_to('Container.clone').clone_incomplete)
+
+    def test_clone_chunked_resume_linking(self):
+        events = []
+        def clone_progress(metrics, step):
+            events.append(step)
+        with self.admin_access.repo_cnx() as cnx:
+            babar = cnx.find('Project', name=u'Babar').one()
+            clone = cnx.create_entity('Project', name=u'Babar relinked clone')
+            cnx.commit()
+            cloner = clone.cw_adapt_to('Container.clone')
+            cloner.clone_chunked = True
+            cloner.clone_progress = clone_progress
+            run_deferred_hooks = cloner._run_deferred_hooks
+            def recording_run_deferred_hooks():
+                events.append('deferred_hooks')
+                run_deferred_hooks()
+            cloner._run_deferred_hooks = recording_run_deferred_hooks
+            insert_relations_by_eid = cloner._insert_relations_by_eid
+            linked = []
+            def crashing_insert_relations_by_eid(rtype, subjects, objects):
+                if linked:
+                    raise RuntimeError('crash')
+                linked.append(rtype)
+                insert_relations_by_eid(rtype, subjects, objects)
+            cloner._insert_relations_by_eid = crashing_insert_relations_by_eid
+            with cnx.deny_all_hooks_but(*cloner.config.compulsory_hooks_categories):
+                with self.assertRaises(RuntimeError):
+                    cloner.clone(original=babar.eid)
+                cnx.rollback()
+                # the deferred hooks of the committed link step have been run
+                step = 'link:%s' % linked[0]
+                self.assertIn(step, events)
+                self.assertEqual('deferred_hooks', events[events.index(step) - 1])
+                clone = cnx.entity_from_eid(clone.eid)
+                cloner = clone.cw_adapt_to('Container.clone')
+                self.assertTrue(cloner.clone_incomplete)
+                cloner.clone_chunked = True
+                cloner.clone(original=babar.eid)
+                cnx.commit()
+            clone = cnx.entity_from_eid(clone.eid)
+            self._check_babar_clone(cnx, clone)
+            self.assertFalse(clone.cw_adapt_to('Container.clone').clone_incomplete)
+
+    def test_clone_preprocess_batch(self):
+        pages = []
+        def preprocess_batch(etype, oldeids, columns):
+            if etype == 'Ticket':
+                pages.append(list(oldeids))
+                columns['name'] = [u'cloned %s' % name for name in columns['name']]
+        with self.admin_access.repo_cnx() as cnx:
+            babar = cnx.find('Project', name=u'Babar').one()
+            clone = self._clone_babar(cnx, u'Babar preprocessed clone',
+                                      preprocess_batch=preprocess_batch)
+            self.assertEqual([[t.eid for t in babar.reverse_concerns]], pages)
+            self.assertEqual([u'cloned think about it'],
+                             [t.name for t in clone.reverse_concerns])
+
+    def test_clone_preprocess_attributes_on_instance(self):
+        def preprocess_attributes(etype, oldeid, attributes):
+            if etype == 'Ticket':
+                attributes['name'] = u'cloned %s' % attributes['name']
+        with self.admin_access.repo_cnx() as cnx:
+            # honoured, the sql engine falling back to the python one
+            clone = self._clone_babar(cnx, u'Babar preprocessed clone', clone_engine='sql',
+                                      preprocess_attributes=preprocess_attributes)
+            self.assertEqual([u'cloned think about it'],
+                             [t.name for t in clone.reverse_concerns])
+
+    def test_clone_fulltext_index(self):
+        with self.admin_access.repo_cnx() as cnx:
+            clone = self._clone_babar(cnx, u'Babar unindexed clone')
+            self.assertEqual(1, len(cnx.execute('Any X WHERE X has_text "Celeste"')))
+            for engine in ('python', 'sql'):
+                clone = self._clone_babar(cnx, u'Babar indexed clone %s' % engine,
+                                          clone_engine=engine, clone_fulltext_index=True)
+                cloned_celeste = clone.reverse_subproject_of[0]
+                self.assertIn(cloned_celeste.eid,
+                              [eid for eid, in cnx.execute('Any X WHERE X has_text "Celeste"')])
+
+    def test_clone_metrics(self):
+        steps = []
+        def clone_progress(metrics, step):
+            steps.append(step)
+            self.metrics = metrics
+        with self.admin_access.repo_cnx() as cnx:
+            # nested folders, whose self referencing parent links are
+            # set once all the folders are cloned
+            babar_doc = cnx.find('Folder', name=u'Babar documentation').one()
+            drafts = cnx.create_entity('Folder', name=u'Drafts', parent=babar_doc)
+            cnx.create_entity('Folder', name=u'Old drafts', parent=drafts)
+            cnx.commit()
+            clone = self._clone_babar(cnx, u'Babar measured clone',
+                                      clone_progress=clone_progress)
+            self._check_babar_clone(cnx, clone)
+        metrics = self.metrics
+        self.assertEqual('done', steps[-1])
+        self.assertIn('etype:%s:Ticket' % clone.eid, steps)
+        # Babar's and Celeste's
+        self.assertEqual(2, metrics.fetched['Ticket'])
+        self.assertEqual(2, metrics.inserted['Ticket'])
+        self.assertEqual(sum(metrics.inserted.values()) + 1, metrics.peak_mapping)
+        self.assertEqual(set(['fetch', 'insert', 'relink', 'link', 'deferred_hooks']),
+                         set(metrics.timings))
+        # versions are cloned before tickets (see test_explain)
+        self.assertNotIn('done_in_version', metrics.as_dict()['inlined'])
+        self.assertIn('parent', metrics.as_dict()['inlined'])
+
+    def test_clone_snapshot(self):
+        with self.admin_access.repo_cnx() as cnx:
+            # without snapshots, changes are not even recorded
+            ticket = cnx.execute('Ticket T WHERE T concerns P, P name "Babar"').one()
+            ticket.cw_set(description=u'think about it twice')
+            self.assertFalse([op for op in cnx.pending_operations
+                              if isinstance(op, InvalidateCloneSnapshotsOp)])
+            cnx.commit()
+        config = Container.by_etype('Project')
+        config.clone_snapshot = True
+        try:
+            self._check_clone_snapshot()
+        finally:
+            config.clone_snapshot = False
+
+    def _check_clone_snapshot(self):
+        with self.admin_access.repo_cnx() as cnx:
+            clone = self._clone_babar(cnx, u'Babar snapshot clone')
+            self._check_babar_clone(cnx, clone)
+            babar = cnx.find('Project', name=u'Babar').one()
+            cached = snapshot.get_snapshot(type(clone.cw_adapt_to('Container.clone')),
+                                           babar.eid)
+            reads = len(cached.rows)
+            self.assertGreater(reads, 0)
+            # the second clone only uses the snapshot
+            clone = self._clone_babar(cnx, u'Babar snapshot clone 2')
+            self._check_babar_clone(cnx, clone)
+            self.assertIs(cached, snapshot.get_snapshot(
+                type(clone.cw_adapt_to('Container.clone')), babar.eid))
+            self.assertEqual(reads, len(cached.rows))
+            ticket = cnx.execute('Ticket T WHERE T concerns P, P name "Babar"').one()
+            ticket.cw_set(name=u'think harder')
+            cnx.commit()
+            self.assertFalse(snapshot.has_snapshots())
+            clone = self._clone_babar(cnx, u'Babar snapshot clone 3')
+            cloned_ticket = cnx.execute('Ticket T WHERE T concerns P, P eid %(p)s',
+                                        {'p': clone.eid}).one()
+            self.assertEqual(u'think harder', cloned_ticket.name)
+            snapshot.invalidate_snapshots()
+            # a snapshot taken while a change is not yet committed
+            ticket = cnx.entity_from_eid(ticket.eid)
+            ticket.cw_set(name=u'think again')
+            cached = snapshot.get_snapshot(type(clone.cw_adapt_to('Container.clone')),
+                                           babar.eid)
+            cached.eids.add(ticket.eid)
+            cnx.commit()
+            self.assertFalse(snapshot.has_snapshots())
+
+    def test_explain(self):
+        with self.admin_access.repo_cnx() as cnx:
+            babar = cnx.find('Project', name=u'Babar').one()
+            clone = cnx.create_entity('Project', name=u'Babar clone to be')
+            estimate = clone.cw_adapt_to('Container.clone').explain(original=babar.eid)
+            self.assertEqual({'Project': 2, 'Folder': 2}, dict(estimate.containers))
+            # Babar's and Celeste's
+            self.assertEqual(2, estimate.entities['Ticket'])
+            self.assertEqual(2, estimate.entities['Version'])
+            self.assertEqual(1, estimate.entities['Project'])
+            self.assertEqual(2, estimate.inlined[('Ticket', 'done_in_version')])
+            self.assertIn(('Ticket', 'concerns'), estimate.fast_inlined)
+            self.assertIn(('Ticket', 'done_in_version'), estimate.fast_inlined)
+            # self referencing
+            self.assertIn(('Folder', 'parent'), estimate.deferred_inlined)
+            self.assertGreater(estimate.queries, 0)
+            self.assertEqual(1024 * 2 * EIDSIZE, estimate.mapping_memory)
+            # nothing has been cloned
+            self.assertEqual([clone.eid], [x.eid for x in clone.reverse_project])
+
+    def test_explain_sql_engine(self):
+        with self.admin_access.repo_cnx() as cnx:
+            babar = cnx.find('Project', name=u'Babar').one()
+            clone = cnx.create_entity('Project', name=u'Babar clone to be')
+            cloner = clone.cw_adapt_to('Container.clone')
+            pyestimate = cloner.explain(original=babar.eid)
+            self.assertEqual('python', pyestimate.engine)
+            cloner.clone_engine = 'sql'
+            estimate = cloner.explain(original=babar.eid)
+            self.assertEqual('sql', estimate.engine)
+            self.assertEqual(dict(pyestimate.containers), dict(estimate.containers))
+            self.assertEqual(dict(pyestimate.entities), dict(estimate.entities))
+            self.assertEqual(dict(pyestimate.links), dict(estimate.links))
+            self.assertGreater(estimate.queries, 0)
+            self.assertEqual(0, estimate.mapping_memory)
+            self.assertEqual(0, estimate.buffers_memory)
+            self.assertEqual('sql', estimate.as_dict()['engine'])
+
+    def test_clone_sql_engine(self):
+        with self.admin_access.repo_cnx() as cnx:
+            clone = self._clone_babar(cnx, u'Babar sql clone', clone_engine='sql')
+            self._check_babar_clone(cnx, clone)
+            cloned_celeste = clone.reverse_subproject_of[0]
+            cloned_folder = cnx.execute('Folder F WHERE F documents P, P eid %(p)s',
+                                        {'p': cloned_celeste.eid}).one()
+            self.assertEqual([cloned_folder], cloned_folder.folder_root)
+            self.assertEqual(cnx.base_url() + str(cloned_folder.eid), cloned_folder.cwuri)
+            self.assertEqual(cnx.user.eid, cloned_folder.created_by[0].eid)
+            self.assertEqual('Folder', cloned_folder.cw_etype)
+
+    def test_clone_sql_engine_without_row_number(self):
+        with self.admin_access.repo_cnx() as cnx:
+            babar = cnx.find('Project', name=u'Babar').one()
+            clone = cnx.create_entity('Project', name=u'Babar sql clone')
+            cnx.commit()
+            cloner = clone.cw_adapt_to('Container.clone')
+            engine = SQLCloneEngine(cloner)
+            engine.row_number = False
+            cloner.orig_container_eid = babar.eid
+            with cnx.deny_all_hooks_but(*cloner.config.compulsory_hooks_categories):
+                engine.clone()
+                cnx.commit()
+            clone.cw_clear_all_caches()
+            self._check_babar_clone(cnx, clone)
+
+    def _fan_out_babar(self, cnx, names, **cloner_attrs):
+        babar = cnx.find('Project', name=u'Babar').one()
+        clones = [cnx.create_entity('Project', name=name) for name in names]
+        cnx.commit()
+        cloner = clones[0].cw_adapt_to('Container.clone')
+        for attr, value in cloner_attrs.iteritems():
+            setattr(cloner, attr, value)
+        with cnx.deny_all_hooks_but(*cloner.config.compulsory_hooks_categories):
+            cloner.fan_out(clones[1:], original=babar.eid)
+            cnx.commit()
+        for clone in clones:
+            clone.cw_clear_all_caches()
+        return clones
+
+    def test_fan_out(self):
+        with self.admin_access.repo_cnx() as cnx:
+            clones = self._fan_out_babar(cnx, [u'Babar fan %s' % i for i in range(3)])
+            for clone in clones:
+                self._check_babar_clone(cnx, clone)
+
+    def test_fan_out_sql_engine(self):
+        with self.admin_access.repo_cnx() as cnx:
+            clones = self._fan_out_babar(cnx, [u'Babar sql fan %s' % i for i in range(3)],
+                                         clone_engine='sql')
+            eids = set()
+            for clone in clones:
+                self._check_babar_clone(cnx, clone)
+                cloned_celeste = clone.reverse_subproject_of[0]
+                # the copies do not share anything
+                self.assertEqual([clone.eid], [p.eid for p in cloned_celeste.project])
+                eids.update(e.eid for e in clone.reverse_project)
+            self.assertEqual(3 * 7, len(eids))
+
+    def test_clone_subtree(self):
+        with self.admin_access.repo_cnx() as cnx:
+            babar = cnx.find('Project', name=u'Babar').one()
+            ticket = cnx.execute('Ticket T WHERE T concerns P, P eid %(p)s',
+                                 {'p': babar.eid}).one()
+            cloner = babar.cw_adapt_to('Container.clone')
+            reads = []
+            self._record_reads(cloner, reads)
+            with cnx.deny_all_hooks_but(*cloner.config.compulsory_hooks_categories):
+                clone_eid = cloner.clone_subtree(ticket.eid)
+                cnx.commit()
+            # each query is scoped by the subtree entities of its own etype
+            # (one of each here)
+            scopes = set(query.split('X eid IN (')[1].split(')')[0]
+                         for query, _queryargs in reads if 'X eid IN (' in query)
+            self.assertIn(str(ticket.eid), scopes)
+            self.assertEqual(3, len(scopes))
+            clone = cnx.entity_from_eid(clone_eid)
+            self.assertNotEqual(ticket.eid, clone.eid)
+            self.assertEqual(ticket.name, clone.name)
+            self.assertEqual([babar.eid], [p.eid for p in clone.concerns])
+            self.assertEqual([babar.eid], [p.eid for p in clone.project])
+            self.assertEqual(2, len(babar.reverse_concerns))
+            # the version is out of the subtree
+            self.assertEqual(ticket.done_in_version[0].eid, clone.done_in_version[0].eid)
+            # the patch and the card are cloned
+            patch = ticket.reverse_implements[0]
+            cloned_patch = clone.reverse_implements[0]
+            self.assertNotEqual(patch.eid, cloned_patch.eid)
+            self.assertEqual(patch.content[0].eid, cloned_patch.content[0].eid)
+            cloned_card = clone.requirement[0]
+            self.assertNotEqual(ticket.requirement[0].eid, cloned_card.eid)
+            self.assertEqual([clone.eid], [p.eid for p in cloned_card.container_parent])
+            with self.assertRaises(ValueError):
+                cloner.clone_subtree(babar.eid)
+
+    def test_bare_entities(self):
+        with self.admin_access.repo_cnx() as cnx:
+            schema = cnx.vreg.schema
+            babar = cnx.find('Project', name=u'Babar').one()
+            celeste = cnx.find('Project', name=u'Celeste').one()
+            ticket = cnx.execute('Ticket T WHERE T concerns P, P eid %(p)s',
+                                 {'p': babar.eid}).one()
+            memo = {}
+            projects = utils.bare_entities(cnx, [babar.eid, celeste.eid, babar.eid],
+                                           [schema['Project']], memo)
+            self.assertEqual(['Project'] * 3, [e.cw_etype for e in projects])
+            self.assertIs(projects[0], projects[2])
+            # the memo may be shared between calls
+            others = utils.bare_entities(cnx, [celeste.eid, ticket.eid],
+                                         [schema['Project'], schema['Ticket']], memo)
+            self.assertIs(projects[1], others[0])
+            self.assertEqual('Ticket', others[1].cw_etype)
+
+    def test_reserve_eids(self):
+        with self.admin_access.repo_cnx() as cnx:
+            first = reserve_eids(cnx, 10)
+            proj = cnx.create_entity('Project', name=u'After the block')
+            self.assertGreater(proj.eid, first + 9)
+            # back to back blocks don't overlap
+            second = reserve_eids(cnx, 5)
+            self.assertGreater(second, proj.eid)
+            self.assertEqual(second + 5, reserve_eids(cnx, 1))
+
+    def test_clone_plan(self):
+        with self.admin_access.repo_cnx() as cnx:
+            babar = cnx.find('Project', name=u'Babar').one()
+            celeste = cnx.find('Project', name=u'Celeste').one()
+            plan = babar.cw_adapt_to('Container.clone').plan
+            self.assertIs(plan, celeste.cw_adapt_to('Container.clone').plan)
+            self.assertEqual(['Project', 'Folder', 'Version', 'Ticket', 'Card', 'Patch'],
+                             plan.etypes)
+            self.assertEqual(frozenset(['concerns', 'done_in_version', 'project']),
+                             plan.already_cloned['Ticket'])
+            self.assertEqual(frozenset(['container_etype']),
+                             plan.crossing_border['Ticket'])
+            self.assertIn('requirement', dict(plan.relink_rql['Ticket']))
+            # an instance dependent scope isn't shared
+            cloner_class = type(babar.cw_adapt_to('Container.clone'))
+            class ScopedClone(cloner_class):
+                def _complete_rql(self, etype):
+                    return cloner_class._complete_rql(self, etype)
+            scoped_plan = ScopedClone(cnx, entity=babar).plan
+            self.assertIsNot(plan, scoped_plan)
+            self.assertIsNot(scoped_plan, ScopedClone(cnx, entity=celeste).plan)
+            # which some operations don't support
+            with self.assertRaises(ValueError):
+                ScopedClone(cnx, entity=babar).explain(celeste.eid)
+            ticket = cnx.execute('Ticket T WHERE T concerns P, P eid %(p)s',
+                                 {'p': babar.eid}).one()
+            with self.assertRaises(ValueError):
+                ScopedClone(cnx, entity=babar).clone_subtree(ticket.eid)
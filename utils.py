@@ -14,9 +14,16 @@
 # You should have received a copy of the GNU Lesser General Public License along
 # with this program. If not, see <http://www.gnu.org/licenses/>.
 
-from rql.nodes import Comparison, VariableRef, make_relation
+from array import array
+from collections import defaultdict
+from heapq import heapify, heappop, heappush, merge
+from itertools import izip
+
+from rql.nodes import Comparison, Constant, VariableRef, make_relation
 
 from cubicweb import neg_role
+from cubicweb.__pkginfo__ import numversion as cwversion
+from cubicweb.server.sqlutils import SQL_PREFIX
 
 
 def fsschema(schema):
@@ -145,6 +152,98 @@ def linearize(etype_map, all_etypes):
             if etype in all_etypes]
 
 
+def strongly_connected_components(graph):
+    """ Tarjan 1972: return the strongly connected components of `graph`
+    (a dict from node to its successors) as sorted lists, the components
+    coming after those they lead to """
+    index = {}
+    lowlink = {}
+    stack = []
+    onstack = set()
+    components = []
+
+    def visit(node):
+        index[node] = lowlink[node] = len(index)
+        stack.append(node)
+        onstack.add(node)
+        for succ in sorted(graph.get(node, ())):
+            if succ not in index:
+                visit(succ)
+                lowlink[node] = min(lowlink[node], lowlink[succ])
+            elif succ in onstack:
+                lowlink[node] = min(lowlink[node], index[succ])
+        if lowlink[node] == index[node]:
+            component = []
+            while True:
+                member = stack.pop()
+                onstack.discard(member)
+                component.append(member)
+                if member == node:
+                    break
+            components.append(sorted(component))
+
+    for node in sorted(graph):
+        if node not in index:
+            visit(node)
+    return components
+
+
+def cycle_breaking_order(edges, weights, rank):
+    """ order the nodes of `rank` (a dict from node to its preferred
+    position) after the nodes they depend on, ignoring a minimal set of
+    dependencies to break the cycles
+
+    `edges` maps an edge (a (node, label) tuple) to the nodes it depends
+    on and `weights` maps it to a sortable cost: the cheapest edges of a
+    cycle are ignored first. Returns the ordered nodes and the set of
+    ignored edges.
+    """
+    def graph(ignored):
+        deps = dict((node, set()) for node in rank)
+        for edge, targets in edges.iteritems():
+            if edge not in ignored:
+                deps[edge[0]].update(target for target in targets
+                                     if target != edge[0] and target in rank)
+        return deps
+
+    def cycles(ignored):
+        return [set(component)
+                for component in strongly_connected_components(graph(ignored))
+                if len(component) > 1]
+
+    ignored = set()
+    cyclic = cycles(ignored)
+    while cyclic:
+        for component in cyclic:
+            ignored.add(min((weights[edge], edge)
+                            for edge, targets in edges.iteritems()
+                            if edge not in ignored and edge[0] in component
+                            and (set(targets) - set([edge[0]])) & component)[1])
+        cyclic = cycles(ignored)
+    # keep only the edges which are still needed to break a cycle
+    for _weight, edge in sorted(((weights[edge], edge) for edge in ignored), reverse=True):
+        ignored.discard(edge)
+        if cycles(ignored):
+            ignored.add(edge)
+    # Kahn 1962, ties broken by rank
+    deps = graph(ignored)
+    dependents = defaultdict(set)
+    for node, targets in deps.iteritems():
+        for target in targets:
+            dependents[target].add(node)
+    ready = [(rank[node], node) for node, targets in deps.iteritems() if not targets]
+    heapify(ready)
+    order = []
+    while ready:
+        _rank, node = heappop(ready)
+        order.append(node)
+        for dependent in dependents[node]:
+            deps[dependent].discard(node)
+            if not deps[dependent]:
+                heappush(ready, (rank[dependent], dependent))
+    return order, ignored
+
+
 # clone helpers
 
 def _add_rqlst_restriction(rqlst, rtype, optional=False):
@@ -163,6 +262,31 @@ def _add_rqlst_restriction(rqlst, rtype, optional=False):
         rel.change_optional('right')
 
 
+def _add_rqlst_paging(rqlst, limit, argname='lasteid'):
+    """pick up the main (first) selected variable, order on it and only
+    fetch `limit` rows whose eid is greater than the `argname` query argument
+
+       Any X WHERE X is Case => Any X ORDERBY X LIMIT 100 WHERE X is Case,
+                                X eid > %(lasteid)s
+    """
+    main_var = rqlst.get_variable(rqlst.get_selected_variables().next().name)
+    rel = make_relation(main_var, 'eid', (argname, 'Substitute'), Constant, '>')
+    rqlst.add_restriction(rel)
+    rqlst.add_sort_var(main_var)
+    rqlst.set_limit(limit)
+
+
+def _add_rqlst_eid(rqlst, argname):
+    """restrict the main (first) selected variable to the eid given as the
+    `argname` query argument
+
+       Any X,Y WHERE X is Case, X concerns Y => Any X,Y WHERE X is Case,
+                                                X concerns Y, X eid %(subject)s
+    """
+    main_var = rqlst.get_variable(rqlst.get_selected_variables().next().name)
+    rqlst.add_restriction(make_relation(main_var, 'eid', (argname, 'Substitute'), Constant))
+
+
 def _iter_mainvar_relations(rqlst):
     """pick up the main (first) selected variable and yield
     tuples (rtype, dest_var) for each restriction found in the ST
@@ -187,6 +311,369 @@ def _iter_mainvar_relations(rqlst):
                 yield rel.r_type, rel.children[1].children[0]
 
 
+# compact eid structures
+
+# typecode of the eid arrays: eids are sql INTEGERs (32 bits signed), which
+# a C long (32 or 64 bits, python 2 arrays have no 'q' typecode) always holds
+EID_TYPECODE = 'l'
+# typecode of the arrays of packed eid pairs, None where there is none of
+# 64 bits (they are then kept as lists)
+_KEY_TYPECODE = 'l' if array('l').itemsize == 8 else None
+
+
+class EidMap(object):
+    """A compact eid -> eid mapping, e.g. from original to cloned eids
+
+    Keys and values are stored in two integer arrays indexed by an open
+    addressing (linear probing) hash table. This costs 24 to 48 bytes per
+    entry where a dict of python ints costs more than 100.
+
+    Only the mapping operations used by the clone are provided: `in`,
+    `get`, `[]`, `[]=`, `len`, `iteritems` and `translate`, which maps a
+    whole column of eids at once.
+    """
+    _empty = -1  # eids are positive integers
+
+    def __init__(self, mapping=(), capacity=1024):
+        size = 8
+        while size < capacity:
+            size <<= 1
+        self._alloc(size)
+        self.update(mapping)
+
+    def _alloc(self, size):
+        self._len = 0
+        self._mask = size - 1
+        self._keys = array(EID_TYPECODE, [self._empty]) * size
+        self._values = array(EID_TYPECODE, [0]) * size
+
+    def _slot(self, key):
+        """ return the index of `key` or of the empty slot where it
+        should go """
+        keys = self._keys
+        mask = self._mask
+        empty = self._empty
+        # fibonacci hashing spreads both sequential and strided eids
+        idx = ((key * 11400714819323198485) >> 32) & mask
+        while True:
+            slotkey = keys[idx]
+            if slotkey == key or slotkey == empty:
+                return idx
+            idx = (idx + 1) & mask
+
+    def _grow(self):
+        keys, values = self._keys, self._values
+        empty = self._empty
+        self._alloc(len(keys) * 2)
+        for idx, key in enumerate(keys):
+            if key != empty:
+                self._set(key, values[idx])
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, key):
+        if not isinstance(key, (int, long)) or key < 0:
+            return False
+        return self._keys[self._slot(key)] == key
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, long)) and key >= 0:
+            idx = self._slot(key)
+            if self._keys[idx] == key:
+                return self._values[idx]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if isinstance(key, (int, long)) and key >= 0:
+            idx = self._slot(key)
+            if self._keys[idx] == key:
+                return self._values[idx]
+        return default
+
+    def __setitem__(self, key, value):
+        self._set(key, value)
+
+    def _set(self, key, value):
+        idx = self._slot(key)
+        if self._keys[idx] != key:
+            # keep the load factor under 2/3
+            if (self._len + 1) * 3 > len(self._keys) * 2:
+                self._grow()
+                idx = self._slot(key)
+            self._keys[idx] = key
+            self._len += 1
+        self._values[idx] = value
+
+    def update(self, mapping):
+        if hasattr(mapping, 'iteritems'):
+            mapping = mapping.iteritems()
+        for key, value in mapping:
+            self[key] = value
+
+    def iteritems(self):
+        empty = self._empty
+        values = self._values
+        for idx, key in enumerate(self._keys):
+            if key != empty:
+                yield key, values[idx]
+
+    def translate(self, eids, keep_missing=False):
+        """ return an array of the values of `eids`
+
+        Missing eids raise a KeyError unless `keep_missing` is True, in
+        which case they are kept as is (e.g. out-of-container eids).
+        """
+        keys, values = self._keys, self._values
+        slot = self._slot
+        translated = array(EID_TYPECODE)
+        append = translated.append
+        for eid in eids:
+            idx = slot(eid)
+            if keys[idx] == eid:
+                append(values[idx])
+            elif keep_missing:
+                append(eid)
+            else:
+                raise KeyError(eid)
+        return translated
+
+    def memory_size(self):
+        """ approximate memory footprint in bytes """
+        return (len(self._keys) + len(self._values)) * self._keys.itemsize
+
+
+def eids_etypes(cnx, eids):
+    """ return a dict mapping `eids` to their entity type, in one query """
+    eids = set(eids)
+    if not eids:
+        return {}
+    cursor = cnx.system_sql('SELECT eid, type FROM entities WHERE eid IN (%s)'
+                            % ','.join(str(int(eid)) for eid in eids))
+    return dict(cursor.fetchall())
+
+
+def fti_index_eids(cnx, eids, batchsize=1000):
+    """ add the entities of `eids` whose etype is full text indexed to the
+    full text index, loading them by batches of `batchsize` along with
+    their indexed attributes; return the number of indexed entities """
+    source = cnx.repo.system_source
+    if not source.do_fti:
+        return 0
+    schema = cnx.vreg.schema
+    eids = list(eids)
+    # etype -> indexed attributes
+    indexed = {}
+    count = 0
+    with cnx.security_enabled(read=False):
+        for start in xrange(0, len(eids), batchsize):
+            etype_eids = {}
+            for eid, etype in eids_etypes(cnx, eids[start:start + batchsize]).iteritems():
+                if etype not in indexed:
+                    indexed[etype] = [rschema.type for rschema
+                                      in schema[etype].indexable_attributes()]
+                if indexed[etype]:
+                    etype_eids.setdefault(etype, []).append(eid)
+            for etype, batch in etype_eids.iteritems():
+                attributes = indexed[etype]
+                rset = cnx.execute('Any X,%s WHERE X eid IN (%s), %s' % (
+                    ','.join('A%d' % idx for idx in xrange(len(attributes))),
+                    ','.join(str(eid) for eid in batch),
+                    ', '.join('X %s A%d' % (attr, idx)
+                              for idx, attr in enumerate(attributes))))
+                source.fti_index_entities(cnx, [rset.get_entity(row, 0)
+                                                for row in xrange(len(rset))])
+                count += len(rset)
+    return count
+
+
+def bare_entities(cnx, eids, eschemas, memo=None):
+    """ return a list of entities of the given `eids`, built without any
+    database access (hence with an empty attribute cache)
+
+    `eschemas` are the possible entity types of the eids: when there are
+    several, the actual ones are computed with one query.
+
+    Each eid gets one single entity: `memo` (eid -> entity) is looked up
+    and filled, so that it may be shared between calls (e.g. for the
+    subjects and objects of a batch of links).
+    """
+    if memo is None:
+        memo = {}
+    new = set(eid for eid in eids if eid not in memo)
+    if len(eschemas) == 1:
+        etypes = dict.fromkeys(new, eschemas[0].type)
+    else:
+        etypes = eids_etypes(cnx, new)
+    ecache = cnx.transaction_data.get('ecache', {})
+    etype_class = cnx.vreg['etypes'].etype_class
+    for eid in new:
+        entity = ecache.get(eid)
+        if entity is None:
+            entity = etype_class(etypes[eid])(cnx)
+            entity.eid = eid
+        memo[eid] = entity
+    return [memo[eid] for eid in eids]
+
+
+def bulk_set_inlined(cnx, rtype, subjects, objects, batchsize=10000):
+    """ set the `rtype` inlined relation of `subjects` to `objects` (two
+    columns of eids) with one UPDATE statement per subject etype and
+    batch of `batchsize` links, instead of one full entity update per link
+
+    This is meant for entities created in the current transaction: their
+    metadata are already set, hence only the relation hooks (of the
+    enabled categories) are called.
+    """
+    rschema = cnx.vreg.schema[rtype]
+    assert rschema.inlined, rtype
+    call_hooks = cnx.repo.hm.call_hooks
+    doexecmany = cnx.repo.system_source.doexecmany
+    ecache = cnx.transaction_data.get('ecache', {})
+    subjetypes = rschema.subjects()
+    for start in xrange(0, len(subjects), batchsize):
+        pairs = zip(subjects[start:start + batchsize], objects[start:start + batchsize])
+        if len(subjetypes) == 1:
+            etypes = dict.fromkeys((subj for subj, _obj in pairs), subjetypes[0].type)
+        else:
+            etypes = eids_etypes(cnx, (subj for subj, _obj in pairs))
+        for subj, obj in pairs:
+            call_hooks('before_add_relation', cnx, eidfrom=subj, rtype=rtype, eidto=obj)
+        etype_args = {}
+        for subj, obj in pairs:
+            etype_args.setdefault(etypes[subj], []).append({'eid': subj, 'val': obj})
+            entity = ecache.get(subj)
+            if entity is not None:
+                entity.cw_clear_all_caches()
+        for etype, args in etype_args.iteritems():
+            doexecmany(cnx, 'UPDATE %s%s SET %s%s=%%(val)s WHERE %seid=%%(eid)s'
+                       % (SQL_PREFIX, etype, SQL_PREFIX, rtype, SQL_PREFIX), args)
+        for subj, obj in pairs:
+            call_hooks('after_add_relation', cnx, eidfrom=subj, rtype=rtype, eidto=obj)
+
+
+def reserve_eids(cnx, count):
+    """ reserve a block of `count` consecutive eids and return the first one """
+    source = cnx.repo.system_source
+    if cwversion[:2] >= (3, 21):
+        # create_eid returns the last eid of the block
+        return source.create_eid(cnx, count) - count + 1
+    # cubicweb < 3.21 can only create eids one at a time: bump the sequence
+    # by `count` in one go, holding the lock create_eid itself takes
+    if source.dbdriver == 'postgres':
+        sqls = ("SELECT setval('entities_id_seq', nextval('entities_id_seq') + %s - 1)"
+                % count,)
+    else:
+        # emulated sequence (a one row table)
+        sqls = ('UPDATE entities_id_seq SET last=last+%s' % count,
+                'SELECT last FROM entities_id_seq')
+    with source._eid_creation_lock:
+        for sql in sqls:
+            cursor = cnx.system_sql(sql)
+        return cursor.fetchone()[0] - count + 1
+
+
+class RelationBuffer(object):
+    """Pending (subject eid, object eid) links, stored per rtype as two
+    integer arrays (16 bytes per link instead of more than 100 for a tuple
+    of python ints)
+
+    Links are deduplicated when read back, so the same link may safely be
+    pushed several times.
+    """
+
+    def __init__(self):
+        self._columns = {}
+
+    def _rtype_columns(self, rtype):
+        try:
+            return self._columns[rtype]
+        except KeyError:
+            columns = self._columns[rtype] = (array(EID_TYPECODE), array(EID_TYPECODE))
+            return columns
+
+    def __len__(self):
+        return len(self._columns)
+
+    def __contains__(self, rtype):
+        return rtype in self._columns
+
+    def rtypes(self):
+        return self._columns.keys()
+
+    def count(self, rtype):
+        """ number of (possibly duplicated) links of `rtype` """
+        return len(self._columns[rtype][0]) if rtype in self._columns else 0
+
+    def add(self, rtype, subj, obj):
+        subjects, objects = self._rtype_columns(rtype)
+        subjects.append(subj)
+        objects.append(obj)
+
+    def clear(self):
+        self._columns = {}
+
+    def extend(self, rtype, pairs):
+        subjects, objects = self._rtype_columns(rtype)
+        for subj, obj in pairs:
+            subjects.append(subj)
+            objects.append(obj)
+
+    def update(self, other):
+        """ merge another buffer (or a mapping of rtype to eid pairs) """
+        if isinstance(other, RelationBuffer):
+            for rtype, (osubjects, oobjects) in other._columns.iteritems():
+                subjects, objects = self._rtype_columns(rtype)
+                subjects.extend(osubjects)
+                objects.extend(oobjects)
+        else:
+            for rtype, pairs in other.iteritems():
+                self.extend(rtype, pairs)
+
+    def pairs(self, rtype):
+        """ return the deduplicated list of eid pairs of `rtype` """
+        subjects, objects = self._columns[rtype]
+        return list(izip(*self._dedup(subjects, objects)))
+
+    def translated(self, rtype, eidmap):
+        """ return the deduplicated (subjects, objects) columns of `rtype`
+        translated through `eidmap`
+
+        All subjects must be in `eidmap`, objects which are not (links
+        to out-of-container entities) are kept as is.
+        """
+        subjects, objects = self._columns[rtype]
+        return self._dedup(eidmap.translate(subjects),
+                           eidmap.translate(objects, keep_missing=True))
+
+    @staticmethod
+    def _dedup(subjects, objects, chunksize=65536):
+        """ return the sorted and deduplicated (subjects, objects) columns
+
+        Each pair is packed into one integer key (eids fit in 32 bits);
+        the keys are sorted by chunks of `chunksize`, kept in 64 bits
+        arrays if possible, and the chunks are merged, dropping adjacent
+        duplicates.
+        """
+        chunks = []
+        for start in xrange(0, len(subjects), chunksize):
+            end = start + chunksize
+            chunk = sorted((subj << 32) | obj
+                           for subj, obj in izip(subjects[start:end], objects[start:end]))
+            if _KEY_TYPECODE is not None:
+                chunk = array(_KEY_TYPECODE, chunk)
+            chunks.append(chunk)
+        dsubjects, dobjects = array(EID_TYPECODE), array(EID_TYPECODE)
+        last = None
+        for key in merge(*chunks):
+            if key == last:
+                continue
+            last = key
+            dsubjects.append(key >> 32)
+            dobjects.append(key & 0xffffffff)
+        return dsubjects, dobjects
+
+
 # migration
 
 def synchronize_container_parent_rdefs(schema,